@@ -0,0 +1,69 @@
+"""Startup benchmark for the four entry points.
+
+Launches each script (or its frozen .exe) several times with --startup, which exits right after
+the .env and the log are loaded, and reports the launch latency. With --importtime the .py
+scripts run under `python -X importtime` and the slowest imports are listed.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS = ("main", "sft_rend", "pdf", "sft_precar")
+
+
+def command(path_app, name, frozen, importtime):
+    if frozen:
+        return [os.path.join(path_app, f"{name}.exe"), "--startup"]
+    return [sys.executable, *(["-X", "importtime"] if importtime else []), os.path.join(path_app, f"{name}.py"), "--startup"]
+
+
+def slowest_imports(stderr, top):
+    # Formato de -X importtime: "import time: self [us] | cumulative | imported package"
+    imports = []
+    for line in stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match and not match.group(3):
+            imports.append((int(match.group(2)), match.group(4)))
+    return sorted(imports, reverse=True)[:top]
+
+
+def bench(cmd, runs, env):
+    times = []
+    stderr = ""
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(cmd, env=env, capture_output=True, text=True)
+        times.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(cmd)} terminó con código {result.returncode}: {result.stderr.strip()[-500:]}")
+        stderr = result.stderr
+    return times, stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide la latencia de arranque de los ejecutables de la cadena Tye.")
+    parser.add_argument("--path", default=os.path.dirname(os.path.abspath(__file__)), help="Carpeta de los scripts o ejecutables")
+    parser.add_argument("--runs", type=int, default=10, help="Lanzamientos por script")
+    parser.add_argument("--frozen", action="store_true", help="Mide los .exe en lugar de los .py")
+    parser.add_argument("--importtime", action="store_true", help="Lista las importaciones más lentas (sólo .py)")
+    parser.add_argument("--top", type=int, default=10, help="Cantidad de importaciones a listar")
+    parser.add_argument("scripts", nargs="*", default=SCRIPTS, help="Scripts a medir")
+    args = parser.parse_args()
+
+    env = {**os.environ, "PATH_LOG": os.environ.get("PATH_LOG", tempfile.mkdtemp()), "LOG_NAME": "bench_startup"}
+    print(f"{'script':<12} {'min':>8} {'mediana':>8} {'max':>8}  (ms, {args.runs} lanzamientos)")
+    for name in args.scripts:
+        times, stderr = bench(command(args.path, name, args.frozen, args.importtime and not args.frozen), args.runs, env)
+        print(f"{name:<12} {min(times):>8.0f} {statistics.median(times):>8.0f} {max(times):>8.0f}")
+        if args.importtime and not args.frozen:
+            for cumulative, module in slowest_imports(stderr, args.top):
+                print(f"    {cumulative / 1000:>8.1f} ms  {module}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,67 @@
+import time
+START = time.perf_counter()
 import json
 import random
-import time
+import threading
 import subprocess
 import logging
 import datetime
+import contextlib
 import os
+import importlib
 import sys
-import pyodbc
-import requests
-import xmltodict
 import re
+import hashlib
+import queue
+import types
+import signal
+import multiprocessing
 from dotenv import load_dotenv 
 
+IMPORTS_ELAPSED = time.perf_counter() - START
+IMPORT_TIMES = {}
+
+class LazyModule:
+    """Imports a heavy module on first use and records how long the import took"""
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            start = time.perf_counter()
+            self.module = importlib.import_module(self.name)
+            IMPORT_TIMES[self.name] = time.perf_counter() - start
+        return getattr(self.module, attr)
+
+pyodbc = LazyModule("pyodbc")
+requests = LazyModule("requests")
+xmltodict = LazyModule("xmltodict")
+np = LazyModule("numpy")
+futures = LazyModule("concurrent.futures")
+
+def frozen_imports():
+    # Nunca se ejecuta: deja visibles para PyInstaller los módulos que se importan en forma diferida
+    import pyodbc
+    import requests
+    import xmltodict
+    import numpy
+    import concurrent.futures
+    import sqlite_backend
+    import pdf
+
+def startup_report(ready):
+    # Tiempos de arranque: importaciones, carga del .env y del log, y lanzamiento desde el script anterior de la cadena
+    message = f"Arranque en {(ready - START) * 1000:.0f} ms (importaciones {IMPORTS_ELAPSED * 1000:.0f} ms, .env y log {(ready - START - IMPORTS_ELAPSED) * 1000:.0f} ms)"
+    launched = os.getenv('TYE_LAUNCH_TS')
+    if launched:
+        message += f" - {(time.time() - float(launched)) * 1000:.0f} ms desde el lanzamiento"
+    logging.info(message)
+
+def imports_report():
+    if IMPORT_TIMES:
+        logging.info("Importaciones diferidas: " + ", ".join(f"{name} {elapsed * 1000:.0f} ms" for name, elapsed in IMPORT_TIMES.items()))
+
 
 class Logger:
     def __init__(self, path, log_name):
@@ -45,13 +95,66 @@ class Logger:
         sys.stdout = self.PrintToLog()
         sys.stderr = self.PrintToLog()
 
+    def rotate(self):
+        """Switches the log file when the day changes, for long-running processes"""
+        log_filename = os.path.abspath(os.path.join(self.path, self.__get_log_filename()))
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            if isinstance(handler, logging.FileHandler) and handler.baseFilename != log_filename:
+                new_handler = logging.FileHandler(log_filename, mode='a')
+                new_handler.setFormatter(handler.formatter)
+                root.removeHandler(handler)
+                handler.close()
+                root.addHandler(new_handler)
+
+class Profiler:
+    """Profiles each stage with cProfile and tracemalloc when the script runs with --profile"""
+    def __init__(self, enabled, path, name, top=20):
+        self.enabled = enabled
+        self.path = path
+        self.name = name
+        self.top = top
+        self.run = datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
+
+    def stage(self, stage):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.__profile(stage)
+
+    @contextlib.contextmanager
+    def __profile(self, stage):
+        import cProfile
+        import tracemalloc
+        file_name = os.path.join(self.path, f"{self.name}_{self.run}_{stage}")
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            profile.dump_stats(f"{file_name}.prof")
+            with open(f"{file_name}_mem.txt", 'w', encoding='utf-8') as file:
+                file.write(f"Etapa {stage}: {elapsed:.3f}s - memoria actual {current / 1024:.1f} KiB - pico {peak / 1024:.1f} KiB\n\n")
+                for stat in after.compare_to(before, 'lineno')[:self.top]:
+                    file.write(f"{stat}\n")
+            logging.info(f"Perfil de la etapa {stage}: {elapsed:.3f}s, pico de memoria {peak / 1024:.1f} KiB -> {file_name}.prof")
+
 class Script:
-    def __init__(self, path):
+    def __init__(self, path, args=None):
         self.path = path
+        self.args = args or []
 
     def run(self):
         try:
-            result = subprocess.run(self.path, check=True, text=True, capture_output=False)
+            env = {**os.environ, "TYE_LAUNCH_TS": str(time.time())}
+            result = subprocess.run([self.path, *self.args], check=True, text=True, capture_output=False, env=env)
         except subprocess.CalledProcessError as e:
             logging.error(f"Error al ejecutar el script {self.path}: {e}")
         
@@ -76,17 +179,73 @@ class Cursor:
     def close(self):
         self.cursor.close()
 
+class ErrorDigest:
+    """Buffers error e-mails, groups them by type and sends them as one digest per stage through SP_GR_PRO_MAIL"""
+    def __init__(self, max_messages=5, max_lines=30):
+        self.max_messages = max_messages
+        self.max_lines = max_lines
+        self.errors = {}
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def error_type(message):
+        # El tipo de error es el texto previo a los detalles, sin números de rendición, gasto o legajo
+        return re.sub(r"\d+", "#", message.split(":")[0]).strip()
+
+    def add(self, message, subject="Error"):
+        with self.lock:
+            error = self.errors.setdefault((subject, self.error_type(message)), {"count": 0, "example": message})
+            error["count"] += 1
+
+    def start_run(self):
+        self.sent = 0
+
+    def flush(self, connection, stage=""):
+        with self.lock:
+            errors, self.errors = self.errors, {}
+        if not errors:
+            return
+        total = sum(error["count"] for error in errors.values())
+        if self.sent >= self.max_messages:
+            logging.warning(f"Se alcanzó el límite de {self.max_messages} correos por ejecución, se omite el resumen de {total} errores.")
+            return
+        lines = [f"{error['count']} x {kind}. Ejemplo: {error['example'][:300]}" for (_, kind), error in
+                 sorted(errors.items(), key=lambda item: item[1]["count"], reverse=True)]
+        if len(lines) > self.max_lines:
+            lines = lines[:self.max_lines] + [f"... y {len(lines) - self.max_lines} tipos de error más"]
+        subjects = {subject for subject, _ in errors}
+        subject = subjects.pop() if len(subjects) == 1 else "Error"
+        try:
+            sent = connection.send_email(" | ".join(lines), f"{subject} - {stage} ({total})" if stage else f"{subject} ({total})")
+        except Exception as e:
+            logging.error(f"Error al enviar el resumen de errores: {e}")
+            sent = False
+        if sent:
+            self.sent += 1
+            return
+        # Si el correo no salió los errores quedan en el log y se conservan para el próximo resumen
+        logging.error(f"Resumen de errores no enviado{' (' + stage + ')' if stage else ''}: {' | '.join(lines)}")
+        with self.lock:
+            for key, error in errors.items():
+                kept = self.errors.setdefault(key, {"count": 0, "example": error["example"]})
+                kept["count"] += error["count"]
+
 class Connection:
-    def __init__(self, server, database, username, password, base_prod, driver='{ODBC Driver 17 for SQL Server}'):
+    def __init__(self, server, database, username, password, base_prod, driver='{ODBC Driver 17 for SQL Server}', sqlite_path=None, digest=None):
         self.server = server
         self.database = database
         self.username = username
         self.password = password
         self.driver = driver
+        self.sqlite_path = sqlite_path
+        self.digest = digest
         self.base_prod = base_prod
         self.connection = self.connect()
 
     def connect(self):
+        if self.sqlite_path:
+            return self.connect_sqlite()
         conn_str = f'DSN={self.database};UID={self.username};PWD={self.password}'
         #conn_str = f'SERVER={self.server};DATABASE={self.database};UID={self.username};PWD={self.password};DRIVER={self.driver}'
         try:
@@ -97,6 +256,13 @@ class Connection:
             logging.error(f"Error al conectar a SQL Server: {e}")
             raise
 
+    def connect_sqlite(self):
+        # Backend local de desarrollo que emula los procedimientos almacenados sobre SQLite
+        import sqlite_backend
+        conn = sqlite_backend.connect(self.sqlite_path)
+        logging.info(f"Conexión exitosa a {self.sqlite_path} (SQLite).")
+        return conn
+
     def run_query(self, query, return_data=True):
         with self.connection.cursor() as cursor:
             cursor.execute(query.replace("\n", " "))
@@ -105,13 +271,73 @@ class Connection:
             else:
                 self.connection.commit()
         
+    def stream_query(self, query, size=500):
+        # Lee el resultado por bloques para no cargar todas las filas en memoria
+        with self.connection.cursor() as cursor:
+            cursor.execute(query.replace("\n", " "))
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield from rows
+
     def raise_email_error(self, message, subject="Error"):
+        if self.digest is not None:
+            self.digest.add(message, subject)
+        else:
+            self.send_email(message, subject)
+
+    def send_email(self, message, subject="Error"):
         query = f"""EXEC {self.base_prod}.DBO.SP_GR_PRO_MAIL @CODPER = 'ENVTYE', @DIREML = '', @DIRECC = '', @DIRCCO = '', @VARIABLES = '<ERROR>|{message.replace("'", " ")}#<ASUNTO>|{subject}', @ADJUNTOS = ''"""
         self.run_query(query, False)
+        return True
+
+    def is_alive(self):
+        try:
+            self.run_query("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    def reconnect(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+        self.connection = self.connect()
+    
+    def flush_errors(self, stage=""):
+        if self.digest is not None:
+            self.digest.flush(self, stage)
     
     def close(self):
         self.connection.close()
 
+class ConnectionPool:
+    def __init__(self, size, *args, **kwargs):
+        self.size = size
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(Connection(*args, **kwargs))
+
+    def acquire(self):
+        connection = self.connections.get()
+        if not connection.is_alive():
+            logging.warning(f"La conexión a {connection.database} no responde, se reconecta.")
+            try:
+                connection.reconnect()
+            except Exception:
+                self.connections.put(connection)
+                raise
+        return connection
+
+    def release(self, connection):
+        self.connections.put(connection)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
 class CashAdvance:
     def __init__(self, advance):
         self.nrotye = advance.get("Number", "")
@@ -232,7 +458,7 @@ class Report:
         return f"{self.nrotye} - {self.type} - {self.date} - {self.user_legajo} - {self.user_costcenter} - {self.user_name} - {self.user_email} - {self.card_type} - {self.total_cashadvance} - {self.total_report} - {self.approver_legajo}"
 
 class WebService():
-    def __init__(self, url, api_key):
+    def __init__(self, url, api_key, fetch=True):
         self.url = url
         self.api_key = api_key
         self.session = requests.Session()
@@ -241,6 +467,13 @@ class WebService():
             "X-Api-Key": self.api_key
         })
         self.fields_list = ("Allocation", "CostCenter", "Expense", "CashAdvance", "Report")
+        self.response = None
+        self.cash_advances = []
+        self.reports = []
+        if fetch:
+            self.refresh()
+
+    def refresh(self):
         self.response = self.__get_information_from_tye()
         self.cash_advances = self.__parse_cash_advances()
         self.reports = self.__parse_reports()
@@ -309,38 +542,315 @@ class WebService():
                 logging.info(report_instance)
         return reports
 
-class Inserter:
-    def __init__(self, connection, web_service):
-        self.connection = connection
+class Validator:
+    """Checks all the documents of a run in bulk and quarantines the inconsistent ones before any SQL round-trip"""
+    def __init__(self, web_service, tolerance=0.01):
+        self.web_service = web_service
+        self.tolerance = tolerance
+        self.errors = {}
+        self.warnings = {}
+        self.quarantined = []
+
+    def __add_errors(self, kind, documents, mask, message):
+        for index in np.flatnonzero(mask):
+            document = documents[index]
+            self.errors.setdefault((kind, document.nrotye), []).append(message(index))
+
+    @staticmethod
+    def __periods(values):
+        periods = np.array([int(value) if len(value) == 6 and value.isdigit() else -1 for value in values], dtype=np.int64)
+        months = periods % 100
+        periods[(periods < 0) | (months < 1) | (months > 12)] = -1
+        return periods
+
+    def __validate_reports(self, reports):
+        expenses = [expense for report in reports for expense in report.expenses]
+        expense_report = np.array([i for i, report in enumerate(reports) for _ in report.expenses], dtype=np.int64)
+        expense_amount = np.array([expense.amount for expense in expenses], dtype=np.float64)
+        costcenter_expense = np.array([j for j, expense in enumerate(expenses) for _ in expense.costcenters], dtype=np.int64)
+        costcenter_amount = np.array([costcenter.amount for expense in expenses for costcenter in expense.costcenters], dtype=np.float64)
+
+        # Suma de centros de costo contra el importe de cada gasto
+        costcenter_total = np.bincount(costcenter_expense, weights=costcenter_amount, minlength=len(expenses))
+        costcenter_count = np.bincount(costcenter_expense, minlength=len(expenses))
+        bad_lines = ~np.isclose(costcenter_total, expense_amount, rtol=0, atol=self.tolerance) | (costcenter_count == 0)
+        for j in np.flatnonzero(bad_lines):
+            report = reports[expense_report[j]]
+            self.errors.setdefault(("Report", report.nrotye), []).append(
+                f"Gasto {expenses[j].nrotye}: centros de costo {costcenter_total[j]:.2f} != importe {expense_amount[j]:.2f}")
+
+        # Anticipos mayores que la rendición: es válido (el anticipo cubre los gastos), sólo se informa
+        report_total = np.bincount(expense_report, weights=expense_amount, minlength=len(reports))
+        cashadvance_total = np.array([report.total_cashadvance for report in reports], dtype=np.float64)
+        for i in np.flatnonzero(cashadvance_total > report_total + self.tolerance):
+            self.warnings.setdefault(("Report", reports[i].nrotye), []).append(
+                f"Anticipos {cashadvance_total[i]:.2f} > total de la rendición {report_total[i]:.2f}")
+        # Una rendición sin gastos puede ser la devolución total de un anticipo: se informa sin ponerla en cuarentena
+        for i in np.flatnonzero(np.bincount(expense_report, minlength=len(reports)) == 0):
+            self.warnings.setdefault(("Report", reports[i].nrotye), []).append("Rendición sin gastos")
+
+        # Una sola moneda por rendición
+        currencies, currency_code = np.unique(np.array([expense.currency for expense in expenses], dtype=str), return_inverse=True)
+        empty_code = np.flatnonzero(currencies == "")
+        first_code = np.full(len(reports), len(currencies), dtype=np.int64)
+        last_code = np.full(len(reports), -1, dtype=np.int64)
+        np.minimum.at(first_code, expense_report, currency_code)
+        np.maximum.at(last_code, expense_report, currency_code)
+        mixed = (last_code >= 0) & (first_code != last_code)
+        self.__add_errors("Report", reports, mixed, lambda i: "Gastos con monedas distintas")
+        self.__add_errors("Report", reports, np.isin(first_code, empty_code) | np.isin(last_code, empty_code),
+                          lambda i: "Gastos sin moneda")
+
+        # Período de la rendición y fechas de los gastos
+        report_period = self.__periods([report.date for report in reports])
+        self.__add_errors("Report", reports, report_period < 0, lambda i: f"Período inválido {reports[i].date}")
+        expense_period = self.__periods([re.sub(r"\D", "", expense.date)[:6] for expense in expenses])
+        late = (expense_period >= 0) & (report_period[expense_report] >= 0) & (expense_period > report_period[expense_report])
+        for j in np.flatnonzero(late):
+            report = reports[expense_report[j]]
+            self.errors.setdefault(("Report", report.nrotye), []).append(
+                f"Gasto {expenses[j].nrotye}: fecha {expenses[j].date} fuera del período {report.date}")
+
+    def __validate_cash_advances(self, advances):
+        periods = self.__periods([advance.date for advance in advances])
+        self.__add_errors("CashAdvance", advances, periods < 0, lambda i: f"Período inválido {advances[i].date}")
+        currencies = np.array([advance.currency for advance in advances], dtype=str)
+        self.__add_errors("CashAdvance", advances, currencies == "", lambda i: "Anticipo sin moneda")
+
+    def validate(self):
+        reports = self.web_service.reports
+        advances = self.web_service.cash_advances
+        if reports:
+            self.__validate_reports(reports)
+        if advances:
+            self.__validate_cash_advances(advances)
+
+        self.quarantined = [{"documento": kind, "nrotye": nrotye, "errores": errors} for (kind, nrotye), errors in self.errors.items()]
+        self.web_service.reports = [report for report in reports if ("Report", report.nrotye) not in self.errors]
+        self.web_service.cash_advances = [advance for advance in advances if ("CashAdvance", advance.nrotye) not in self.errors]
+        for (kind, nrotye), warnings in self.warnings.items():
+            logging.warning(f"{kind} {nrotye}: {'; '.join(warnings)}")
+        for document in self.quarantined:
+            logging.error(f"{document['documento']} {document['nrotye']} en cuarentena: {'; '.join(document['errores'])}")
+        logging.info(f"Validación: {len(reports) + len(advances)} documentos, {len(self.quarantined)} en cuarentena.")
+        return self.quarantined
+
+    def save_report(self, path, company=None):
+        prefix = f"validacion_{company}_" if company else "validacion_"
+        file_name = os.path.join(path, prefix + datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S") + ".json")
+        with open(file_name, 'w', encoding='utf-8') as file:
+            json.dump({
+                "documentos": len(self.web_service.reports) + len(self.web_service.cash_advances) + len(self.quarantined),
+                "cuarentena": self.quarantined,
+                "avisos": [{"documento": kind, "nrotye": nrotye, "avisos": warnings} for (kind, nrotye), warnings in self.warnings.items()]
+            }, file, ensure_ascii=False, indent=2)
+        return file_name
+
+class StagingExporter:
+    """Writes the parsed documents of a run as three columnar tables: headers, items and allocations"""
+    def __init__(self, web_service, path, file_format=None):
         self.web_service = web_service
+        self.path = path
+        self.file_format = file_format or self.__default_format()
+        self.run = datetime.datetime.now()
 
-    def cashadvance_insert(self):
+    @staticmethod
+    def __default_format():
+        try:
+            import pyarrow
+            return "parquet"
+        except ImportError:
+            return "npz"
+
+    def __headers(self):
+        columns = {name: [] for name in ("documento", "nrotye", "tipren", "period", "user_legajo", "user_costcenter", "user_name",
+                                          "user_email", "card_type", "currency", "total_report", "total_cashadvance", "approver_legajo")}
         for advance in self.web_service.cash_advances:
+            for name, value in zip(columns, ("CashAdvance", advance.nrotye, advance.type, advance.date, advance.user_legajo, advance.user_costcenter,
+                                              advance.user_name, advance.user_email, "", advance.currency, advance.amount, 0.0, advance.approver_legajo)):
+                columns[name].append(value)
+        for report in self.web_service.reports:
+            currency = report.expenses[0].currency if report.expenses else ""
+            for name, value in zip(columns, ("Report", report.nrotye, report.type, report.date, report.user_legajo, report.user_costcenter,
+                                              report.user_name, report.user_email, report.card_type, currency, report.total_report,
+                                              report.total_cashadvance, report.approver_legajo)):
+                columns[name].append(value)
+        return columns
+
+    def __items(self):
+        columns = {name: [] for name in ("nrotye", "tipren", "nroitm", "expense_nrotye", "date", "account", "expense_type", "currency", "amount",
+                                          "ticket_number", "receipt_type", "cuit", "provider", "letter", "location", "receipt_link",
+                                          "recognized", "personal", "reimburs")}
+        for report in self.web_service.reports:
+            for i, expense in enumerate(report.expenses, 1):
+                for name, value in zip(columns, (report.nrotye, report.type, i, expense.nrotye, expense.date, expense.account, expense.expense_type,
+                                                  expense.currency, expense.amount, expense.ticket_number, expense.receipt_type, expense.cuit,
+                                                  expense.provider, expense.letter, expense.location, expense.receipt_link, expense.recognized,
+                                                  expense.personal, expense.reimburs)):
+                    columns[name].append(value)
+        return columns
+
+    def __allocations(self):
+        columns = {name: [] for name in ("nrotye", "tipren", "nroitm", "nroitp", "rl", "rp", "codigo_vinc", "amount", "approver_legajo")}
+        for report in self.web_service.reports:
+            for i, expense in enumerate(report.expenses, 1):
+                for k, costcenter in enumerate(expense.costcenters, 1):
+                    for name, value in zip(columns, (report.nrotye, report.type, i, k, costcenter.rl, costcenter.rp, costcenter.codigo_vinc,
+                                                      costcenter.amount, costcenter.approver_legajo)):
+                        columns[name].append(value)
+        return columns
+
+    @staticmethod
+    def __to_arrays(columns):
+        arrays = {}
+        for name, values in columns.items():
+            if name in ("amount", "total_report", "total_cashadvance"):
+                arrays[name] = np.array(values, dtype=np.float64)
+            elif name in ("nroitm", "nroitp"):
+                arrays[name] = np.array(values, dtype=np.int32)
+            else:
+                arrays[name] = np.array([str(value) for value in values], dtype=str)
+        return arrays
+
+    def __write(self, table, columns):
+        folder_path = os.path.join(self.path, table, self.run.strftime("fecha=%Y-%m-%d"))
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        file_name = os.path.join(folder_path, self.run.strftime(f"%H.%M.%S.{self.file_format}"))
+        arrays = self.__to_arrays(columns)
+        if self.file_format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            pq.write_table(pa.table(arrays), file_name, compression="zstd")
+        else:
+            np.savez_compressed(file_name, **arrays)
+        return file_name, len(next(iter(arrays.values())))
+
+    def export(self):
+        for table, columns in (("headers", self.__headers()), ("items", self.__items()), ("allocations", self.__allocations())):
+            file_name, rows = self.__write(table, columns)
+            logging.info(f"Staging {table}: {rows} filas en {file_name}")
+
+class Retrier:
+    """Retries database operations that fail with a deadlock or a lock/query timeout, with jittered exponential backoff"""
+    sqlstates = {"40001", "HYT00", "HYT01"}
+    native_codes = {1205, 1222, -2}
+
+    def __init__(self, retries=3, backoff=1.0, max_backoff=30.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.attempts = {}
+        self.recovered = {}
+        self.exhausted = {}
+        self.lock = threading.Lock()
+
+    def __count(self, counter, kind):
+        with self.lock:
+            counter[kind] = counter.get(kind, 0) + 1
+
+    def is_retryable(self, error):
+        args = getattr(error, "args", ())
+        sqlstate = args[0] if args and isinstance(args[0], str) else ""
+        # Una violación de integridad nunca se resuelve reintentando, aunque el valor de la clave parezca un código nativo
+        if sqlstate == "23000":
+            return False
+        message = " ".join(str(arg) for arg in args[1:]) if len(args) > 1 else str(error)
+        # El código nativo es el sufijo del driver: "... (1205) (SQLExecDirectW)" o "(1205)" al final del mensaje
+        codes = {int(code) for code in re.findall(r"\((-?\d+)\)\s*(?:\(SQL\w+\)|$)", message)}
+        return sqlstate in self.sqlstates or bool(codes & self.native_codes)
+
+    def run(self, kind, label, operation, *args, **kwargs):
+        attempt = 0
+        while True:
             try:
-                advance.nromov = self.connection.run_query(f"""
-                    EXEC SP_CO_REND_MAX_CORRTH 
-                        @INICIA = '{advance.user_legajo}'
-                        , @PERIOD = {advance.date}
-                """)[0][0]
-                advance_query = f"""
-                        EXEC SP_CO_REND_INS_CORRTH 
-                        @INICIA = '{advance.user_legajo}'
-                        , @PERIOD = {advance.date}
-                        , @NROMOV = {advance.nromov}
-                        , @NROSFT = NULL
-                        , @NROTYE = {advance.nrotye}
-                        , @TIPREN = {advance.type}
-                        , @MONEDA = '{advance.currency}' 
-                        , @IMPORT = {advance.amount}
-                        , @IMPANT = 0
-                        , @USRAUT = '{advance.approver_legajo}'
-                        , @TARJET = ''
-                        """
-                self.connection.run_query(advance_query, False)
-                logging.info(f"|_Registro C - {advance.nrotye} insertado: {1}")
+                result = operation(*args, **kwargs)
+                if attempt:
+                    self.__count(self.recovered, kind)
+                return result
             except Exception as e:
+                if not self.is_retryable(e):
+                    raise
+                if attempt >= self.retries:
+                    self.__count(self.exhausted, kind)
+                    raise
+                attempt += 1
+                self.__count(self.attempts, kind)
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                logging.warning(f"Reintento {attempt}/{self.retries} de {kind} {label} en {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    def report(self):
+        for kind in sorted(set(self.attempts) | set(self.exhausted)):
+            logging.info(f"Reintentos {kind}: {self.attempts.get(kind, 0)} - Recuperados: {self.recovered.get(kind, 0)} - Agotados: {self.exhausted.get(kind, 0)}")
+
+class Inserter:
+    def __init__(self, connection, web_service, retrier=None):
+        self.connection = connection
+        self.web_service = web_service
+        self.retrier = retrier or Retrier()
+        self.inserted = set()
+        # Documentos rechazados por SQL con un error que no se resuelve reintentando (clave duplicada, tarjeta pendiente, ...)
+        self.rejected = set()
+
+    def __cashadvance_execute(self, cursor, advance):
+        advance.nromov = cursor.execute(f"""
+            EXEC SP_CO_REND_MAX_CORRTH 
+                @INICIA = '{advance.user_legajo}'
+                , @PERIOD = {advance.date}
+        """)[0][0]
+        advance_query = f"""
+                EXEC SP_CO_REND_INS_CORRTH 
+                @INICIA = '{advance.user_legajo}'
+                , @PERIOD = {advance.date}
+                , @NROMOV = {advance.nromov}
+                , @NROSFT = NULL
+                , @NROTYE = {advance.nrotye}
+                , @TIPREN = {advance.type}
+                , @MONEDA = '{advance.currency}' 
+                , @IMPORT = {advance.amount}
+                , @IMPANT = 0
+                , @USRAUT = '{advance.approver_legajo}'
+                , @TARJET = ''
+                """
+        cursor.execute(advance_query, False)
+
+    def __cashadvance_transaction(self, advances):
+        cursor = Cursor(self.connection)
+        try:
+            for advance in advances:
+                self.__cashadvance_execute(cursor, advance)
+            cursor.commit()
+        except Exception:
+            cursor.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def __cashadvance_group(self, advances):
+        label = advances[0].nrotye if len(advances) == 1 else f"lote de {len(advances)}"
+        try:
+            self.retrier.run("C", label, self.__cashadvance_transaction, advances)
+        except Exception as e:
+            if len(advances) == 1:
                 logging.error(f"Error al insertar datos C: {e}")
-                #error
+                if not self.retrier.is_retryable(e):
+                    self.rejected.add(("CashAdvance", advances[0].nrotye))
+                return
+            # Se divide el lote para aislar los anticipos con error sin perder el resto
+            logging.warning(f"Error en el lote de {len(advances)} anticipos, se divide para aislar el error: {e}")
+            half = len(advances) // 2
+            self.__cashadvance_group(advances[:half])
+            self.__cashadvance_group(advances[half:])
+            return
+        for advance in advances:
+            self.inserted.add((advance.type, advance.nrotye))
+            logging.info(f"|_Registro C - {advance.nrotye} insertado: {1}")
+
+    def cashadvance_insert(self, batch_size=1):
+        advances = [advance for advance in self.web_service.cash_advances if (advance.type, advance.nrotye) not in self.inserted]
+        for start in range(0, len(advances), batch_size):
+            self.__cashadvance_group(advances[start:start + batch_size])
 
     def __costcenter_insert(self,report, expense):
         for k, costcenter in enumerate(expense.costcenters, 1):
@@ -399,8 +909,9 @@ class Inserter:
             logging.info(f"|___Registro I - {expense.nrotye} insertado: {1}")
             self.__costcenter_insert(report, expense)
 
-    def advance_update(self, advance_numbers, nrotye):
-        """Updates multiple cash advances with the report number they're associated with"""
+    def advance_update(self, advance_numbers, nrotye, cursor=None):
+        """Updates multiple cash advances with the report number they're associated with.
+        When a cursor is given the updates join its transaction instead of being committed one by one"""
         try:
             for advance_number in advance_numbers:
                 update_query = f"""
@@ -408,50 +919,80 @@ class Inserter:
                         @NROANT = {advance_number}  
                         , @NROTYE = {nrotye}
                 """
-                self.connection.run_query(update_query, False)
+                if cursor:
+                    cursor.execute(update_query, False)
+                else:
+                    self.connection.run_query(update_query, False)
                 logging.info(f"|_Advance {advance_number} acutalizado para rendicion {nrotye}")
         except Exception as e:
             logging.error(f"Error updating advances for report {nrotye}: {e}")
             raise
 
+    def __report_transaction(self, report):
+        report.cursor = Cursor(self.connection)
+        try:
+            report.nromov = report.cursor.execute(f"""
+                EXEC SP_CO_REND_MAX_CORRTH 
+                    @INICIA = '{report.user_legajo}'
+                    , @PERIOD = {report.date}
+                """)[0][0]
+            report_query = f"""
+                EXEC SP_CO_REND_INS_CORRTH 
+                @INICIA = '{report.user_legajo}'
+                , @PERIOD = {report.date}
+                , @NROMOV = {report.nromov}
+                , @NROSFT = NULL
+                , @NROTYE = {report.nrotye}
+                , @TIPREN = {report.type}
+                , @MONEDA = ''
+                , @IMPORT = {report.total_report}
+                , @IMPANT = {report.total_cashadvance}
+                , @USRAUT = '{report.approver_legajo}'
+                , @TARJET = '{report.card_type}'
+                """
+            report.cursor.execute(report_query, False)
+
+            if report.advance_numbers:
+                self.advance_update(report.advance_numbers, report.nrotye, report.cursor)
+                
+            logging.info(f"|_Registro H - {report.nrotye} insertado: {1}")
+            self.__expense_insert(report)
+            report.cursor.commit()
+        except Exception:
+            # La transacción completa se deshace, así un reintento nunca inserta dos veces
+            report.cursor.rollback()
+            raise
+        finally:
+            report.cursor.close()
+
     def report_insert(self):
         for report in self.web_service.reports:
+            if (report.type, report.nrotye) in self.inserted:
+                logging.info(f"La rendición {report.nrotye} ya fue insertada en esta ejecución.")
+                continue
             try:
-                report.cursor = Cursor(self.connection)
-                report.nromov = report.cursor.execute(f"""
-                    EXEC SP_CO_REND_MAX_CORRTH 
-                        @INICIA = '{report.user_legajo}'
-                        , @PERIOD = {report.date}
-                    """)[0][0]
-                report_query = f"""
-                    EXEC SP_CO_REND_INS_CORRTH 
-                    @INICIA = '{report.user_legajo}'
-                    , @PERIOD = {report.date}
-                    , @NROMOV = {report.nromov}
-                    , @NROSFT = NULL
-                    , @NROTYE = {report.nrotye}
-                    , @TIPREN = {report.type}
-                    , @MONEDA = ''
-                    , @IMPORT = {report.total_report}
-                    , @IMPANT = {report.total_cashadvance}
-                    , @USRAUT = '{report.approver_legajo}'
-                    , @TARJET = '{report.card_type}'
-                    """
-                report.cursor.execute(report_query, False)
-
-                if report.advance_numbers:
-                    self.advance_update(report.advance_numbers, report.nrotye)
-                    
-                logging.info(f"|_Registro H - {report.nrotye} insertado: {1}")
-                self.__expense_insert(report)
-                report.cursor.commit()
+                self.retrier.run("H", report.nrotye, self.__report_transaction, report)
+                self.inserted.add((report.type, report.nrotye))
             except Exception as e:
                 if e.args[0] == '23000' and report.type == 2:
                     logging.error(f"La rendición de tarjeta {report.nrotye} está a la espera de ser procesada.")
                 else:
                     logging.error(f"Error al insertar datos  H - {report.nrotye}: {e}")
-                report.cursor.rollback()
-                #error
+                if not self.retrier.is_retryable(e):
+                    self.rejected.add(("Report", report.nrotye))
+
+# Reglas de envío de novedades por (NOVEDA, TIPREN); las combinaciones que no figuran no se envían
+NEWS_RULES = {
+    (0, 1): lambda nrosft, importe, compag, ctacte, impant: True,
+    (0, 2): lambda nrosft, importe, compag, ctacte, impant: True,
+    (0, 4): lambda nrosft, importe, compag, ctacte, impant: True,
+    (1, 1): lambda nrosft, importe, compag, ctacte, impant: nrosft != None and ctacte != None and (importe <= impant or compag != None),
+    (1, 4): lambda nrosft, importe, compag, ctacte, impant: nrosft != None and ctacte != None and compag != None
+}
+
+def is_news(tipren, nrosft, importe, compag, noveda, ctacte, impant):
+    rule = NEWS_RULES.get((0 if noveda == None else noveda, tipren))
+    return rule is not None and rule(nrosft, importe, compag, ctacte, impant)
 
 class Notifier:
     def __init__(self, company, nrotye, tipren, nrosft, importe, compag, noveda, ctacte, impant):
@@ -465,21 +1006,11 @@ class Notifier:
         self.ctacte = ctacte
         self.impant = impant
         self.document = "CashAdvance" if self.tipren == 4 else "Report"
-        self.news = {
-            0: {
-                1: self.noveda == 0 and self.tipren == 1,
-                2: self.noveda == 0 and self.tipren == 2,
-                4: self.noveda == 0 and self.tipren == 4
-                }, 
-            1: {
-                1: self.noveda == 1 and self.tipren == 1 and self.nrosft != None and self.ctacte != None and (self.importe <= self.impant or self.compag != None),
-                4: self.noveda == 1 and self.tipren == 4 and self.nrosft != None and self.ctacte != None and self.compag != None 
-                }
-            }
+        self.valid = is_news(self.tipren, self.nrosft, self.importe, self.compag, self.noveda, self.ctacte, self.impant)
         self.new = self.generate_new()
         
     def get_new_validation(self):
-        return self.news.get(self.noveda, {}).get(self.tipren, False)
+        return self.valid
 
     def generate_new(self):
         if self.get_new_validation() == True:
@@ -501,22 +1032,34 @@ class Notifier:
         return f"{self.nrotye} - {self.tipren} - {self.nrosft} - {self.importe} - {self.compag} - {self.noveda} - {self.ctacte}"
         
 class Updater:
-    def __init__(self, connection, company):
+    def __init__(self, connection, company, stream=False, fetch_size=500):
         self.connection = connection
         self.company = company
-        self.reports = self.__get_update_reports()
+        self.fetch_size = fetch_size
+        self.reports = self.__stream_update_reports() if stream else self.__get_update_reports()
 
     def __get_update_reports(self):
         reports = self.connection.run_query("EXEC SP_CO_REND_GET_UPDATE_CORRTH", True)
         return [Notifier(self.company, *report) for report in reports]
 
+    def __stream_update_reports(self):
+        # Sólo se arma el Notifier (y su XML) de las filas que tienen novedad para enviar
+        reports = []
+        pending = 0
+        for report in self.connection.stream_query("EXEC SP_CO_REND_GET_UPDATE_CORRTH", self.fetch_size):
+            pending += 1
+            if is_news(*report[1:]):
+                reports.append(Notifier(self.company, *report))
+        logging.info(f"Novedades a enviar: {len(reports)} de {pending} reportes pendientes.")
+        return reports
+
     def get_sender(self):
-        data = ""
+        data = []
         for report in self.reports:
-            data += report.new
             if report.new != "":
+                data.append(report.new)
                 logging.info(f"""Reporte {report.nrotye} enviado con novedad {report.noveda + 1}.""")
-        return data
+        return "".join(data)
     
     def update_reports(self):
         for report in self.reports:
@@ -532,6 +1075,330 @@ class Updater:
                     logging.error(f"Error al actualizar el reporte {report.nrotye}: {e}")
                     self.connection.raise_email_error(f"Error al actualizar el reporte {report.nrotye}: {e}")
 
+def ingest(connection, web_service, inserter, path_log, profiler, save_empty=True):
+    quarantined = []
+    if os.getenv('VALIDATE_REPORTS', 'S').upper() == 'S':
+        with profiler.stage("validacion"):
+            validator = Validator(web_service)
+            quarantined = validator.validate()
+            if quarantined or save_empty:
+                file_name = validator.save_report(path_log)
+        if quarantined:
+            connection.raise_email_error(f"{len(quarantined)} documentos de Tye en cuarentena por errores de validación. Detalle en {file_name}")
+
+    path_staging = os.getenv('PATH_STAGING')
+    if path_staging:
+        try:
+            with profiler.stage("staging"):
+                StagingExporter(web_service, path_staging, os.getenv('STAGING_FORMAT')).export()
+        except Exception as e:
+            logging.error(f"Error al exportar el staging de la ejecución: {e}")
+
+    with profiler.stage("anticipos"):
+        inserter.cashadvance_insert(int(os.getenv('CASHADVANCE_BATCH_SIZE', 50)))
+    with profiler.stage("rendiciones"):
+        inserter.report_insert()
+    inserter.retrier.report()
+    return quarantined
+
+def send_news(connection, web_service, company, profiler):
+    with profiler.stage("novedades"):
+        updater = Updater(connection, company,
+                          stream=os.getenv('UPDATER_STREAM', 'N').upper() == 'S',
+                          fetch_size=int(os.getenv('UPDATER_FETCH_SIZE', 500)))
+        news = updater.get_sender()
+        if news:
+            status = web_service.send_soap_request(news)
+            if status == 200:
+                updater.update_reports()
+            else:
+                connection.raise_email_error("Error al enviar la información de novedades a Tye.")
+
+class Daemon:
+    """Polls Tye on a fixed interval and runs the ingest, news and receipt stages with warm connections and session"""
+    def __init__(self, logger, pool, web_service, inserter, company, profiler, interval=300, jitter=30, quiet_hours="", status_file=None, receipts=None):
+        self.logger = logger
+        self.pool = pool
+        self.web_service = web_service
+        self.inserter = inserter
+        self.company = company
+        self.profiler = profiler
+        self.interval = interval
+        self.jitter = jitter
+        self.quiet_hours = self.__parse_quiet_hours(quiet_hours)
+        self.status_file = status_file
+        self.receipts = receipts
+        self.quarantined = {}
+        self.rejected = {}
+        self.stop_event = threading.Event()
+        self.status = {
+            "estado": "iniciando",
+            "pid": os.getpid(),
+            "inicio": datetime.datetime.now().isoformat(timespec="seconds"),
+            "ticks": 0,
+            "ticks_con_error": 0,
+            "ultimo_tick": None,
+            "proximo_tick": None
+        }
+
+    @staticmethod
+    def __parse_quiet_hours(quiet_hours):
+        # Formato "HH[:MM]-HH[:MM]", por ejemplo "22-06" o "21:30-05:45"
+        if not quiet_hours:
+            return None
+        start, end = (datetime.time(*(int(part) for part in value.strip().split(":"))) for value in quiet_hours.split("-"))
+        return start, end
+
+    def in_quiet_hours(self, now):
+        if not self.quiet_hours:
+            return False
+        start, end = self.quiet_hours
+        if start <= end:
+            return start <= now.time() < end
+        return now.time() >= start or now.time() < end
+
+    def __write_status(self):
+        if not self.status_file:
+            return
+        temp_file = f"{self.status_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            json.dump(self.status, file, ensure_ascii=False, indent=2)
+        os.replace(temp_file, self.status_file)
+
+    @staticmethod
+    def fingerprint(document):
+        # Huella del contenido del documento para volver a validarlo si cambia en Tye
+        data = {name: value for name, value in vars(document).items() if name != "cursor"}
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=lambda value: vars(value) if hasattr(value, "__dict__") else str(value)).encode()).hexdigest()
+
+    def __pending(self):
+        # Cada ciclo recibe de nuevo todo lo pendiente en Tye: sólo se procesan los documentos nuevos o modificados.
+        # Lo ya insertado, en cuarentena o rechazado por SQL se olvida cuando deja de figurar en Tye, así los registros no crecen sin límite
+        documents = [("CashAdvance", advance) for advance in self.web_service.cash_advances] + [("Report", report) for report in self.web_service.reports]
+        present = {(document.type, document.nrotye) for _, document in documents}
+        self.inserter.inserted &= present
+        fingerprints = {(kind, document.nrotye): self.fingerprint(document) for kind, document in documents}
+        self.quarantined = {key: value for key, value in self.quarantined.items() if key in fingerprints}
+        self.rejected = {key: value for key, value in self.rejected.items() if key in fingerprints}
+
+        def pending(kind, document):
+            key = (kind, document.nrotye)
+            return ((document.type, document.nrotye) not in self.inserter.inserted
+                    and self.quarantined.get(key) != fingerprints[key] and self.rejected.get(key) != fingerprints[key])
+        self.web_service.cash_advances = [advance for advance in self.web_service.cash_advances if pending("CashAdvance", advance)]
+        self.web_service.reports = [report for report in self.web_service.reports if pending("Report", report)]
+        for kind, documents in (("CashAdvance", self.web_service.cash_advances), ("Report", self.web_service.reports)):
+            for document in documents:
+                self.quarantined.pop((kind, document.nrotye), None)
+                self.rejected.pop((kind, document.nrotye), None)
+        return fingerprints
+
+    def __ingest(self, connection):
+        fingerprints = self.__pending()
+        self.inserter.rejected.clear()
+        quarantined = ingest(connection, self.web_service, self.inserter, self.logger.path, self.profiler, save_empty=False)
+        for document in quarantined:
+            key = (document["documento"], document["nrotye"])
+            self.quarantined[key] = fingerprints[key]
+        # Un documento rechazado se vuelve a enviar sólo cuando cambia en Tye
+        for key in self.inserter.rejected:
+            self.rejected[key] = fingerprints[key]
+
+    def __receipts(self, connection):
+        import pdf
+        # El pool de procesos de normalización se crea en cada ciclo y se cierra al terminar las descargas
+        pdfs = pdf.Pdf(connection, **self.receipts, normalizer=pdf.build_normalizer(self.receipts["path_pdf"]))
+        pdfs.update_pdfs()
+
+    def tick(self):
+        tick = {"inicio": datetime.datetime.now().isoformat(timespec="seconds"), "etapas": {}, "error": None}
+        inserted = set(self.inserter.inserted)
+        start = time.perf_counter()
+        connection = None
+        try:
+            connection = self.pool.acquire()
+            if connection.digest is not None:
+                connection.digest.start_run()
+            self.inserter.connection = connection
+            stages = [
+                ("tye", self.web_service.refresh),
+                ("ingesta", lambda: self.__ingest(connection)),
+                ("novedades", lambda: send_news(connection, self.web_service, self.company, self.profiler))
+            ]
+            if self.receipts:
+                stages.append(("comprobantes", lambda: self.__receipts(connection)))
+            for name, stage in stages:
+                stage_start = time.perf_counter()
+                stage()
+                tick["etapas"][name] = round(time.perf_counter() - stage_start, 3)
+                connection.flush_errors(name)
+        except Exception as e:
+            tick["error"] = str(e)
+            self.status["ticks_con_error"] += 1
+            logging.error(f"Error en el ciclo del servicio: {e}")
+        finally:
+            if connection:
+                connection.flush_errors("ciclo")
+                self.pool.release(connection)
+        tick["fin"] = datetime.datetime.now().isoformat(timespec="seconds")
+        tick["duracion"] = round(time.perf_counter() - start, 3)
+        tick["anticipos"] = len(self.web_service.cash_advances)
+        tick["rendiciones"] = len(self.web_service.reports)
+        tick["insertados"] = len(self.inserter.inserted - inserted)
+        tick["cuarentena"] = len(self.quarantined)
+        tick["rechazados"] = len(self.rejected)
+        self.status["ticks"] += 1
+        self.status["ultimo_tick"] = tick
+        logging.info(f"Ciclo {self.status['ticks']} terminado en {tick['duracion']:.1f}s: {tick['insertados']} documentos nuevos.")
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logging.info(f"Servicio iniciado: intervalo {self.interval}s, jitter {self.jitter}s.")
+        while not self.stop_event.is_set():
+            now = datetime.datetime.now()
+            self.logger.rotate()
+            if self.in_quiet_hours(now):
+                self.status["estado"] = "silencio"
+            else:
+                self.status["estado"] = "procesando"
+                self.__write_status()
+                self.tick()
+                self.status["estado"] = "error" if self.status["ultimo_tick"]["error"] else "activo"
+            delay = max(1, self.interval + random.uniform(-self.jitter, self.jitter))
+            self.status["proximo_tick"] = (datetime.datetime.now() + datetime.timedelta(seconds=delay)).isoformat(timespec="seconds")
+            self.__write_status()
+            self.stop_event.wait(delay)
+        self.status["estado"] = "detenido"
+        self.status["proximo_tick"] = None
+        self.__write_status()
+        logging.info("Servicio detenido.")
+
+class Tenant:
+    """Runs the fetch, insert and news stages of one company over its own connection pool"""
+    # Sin estas claves una empresa tomaría las del .env y cargaría los documentos de la empresa por defecto en su base
+    required = ("COMPANY", "URL", "API_KEY", "BASE_TYE", "BASE_PRODUCTIVA")
+
+    def __init__(self, settings, retrier, path_log, number=1):
+        self.settings = settings
+        self.retrier = retrier
+        self.path_log = path_log
+        self.company = settings.get('COMPANY') or f"empresa {number}"
+        self.max_workers = int(self.get('MAX_WORKERS', 2))
+        self.pool_size = int(self.get('POOL_SIZE', self.max_workers))
+        self.timings = {}
+        self.counts = {}
+
+    def get(self, key, default=None):
+        # Cada empresa puede redefinir cualquier variable del .env
+        return self.settings.get(key, os.getenv(key, default))
+
+    def __timed(self, stage, operation, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return operation(*args, **kwargs)
+        finally:
+            self.timings[stage] = round(time.perf_counter() - start, 3)
+
+    def __insert_group(self, pool, documents):
+        connection = pool.acquire()
+        try:
+            inserter = Inserter(connection, documents, self.retrier)
+            inserter.cashadvance_insert(int(self.get('CASHADVANCE_BATCH_SIZE', 50)))
+            inserter.report_insert()
+            return len(inserter.inserted)
+        finally:
+            pool.release(connection)
+
+    def __insert(self, pool, web_service):
+        # Los documentos de un mismo legajo van al mismo hilo para que SP_CO_REND_MAX_CORRTH no asigne dos veces el mismo NROMOV
+        groups = {}
+        for advance in web_service.cash_advances:
+            groups.setdefault(advance.user_legajo, types.SimpleNamespace(cash_advances=[], reports=[])).cash_advances.append(advance)
+        for report in web_service.reports:
+            groups.setdefault(report.user_legajo, types.SimpleNamespace(cash_advances=[], reports=[])).reports.append(report)
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.company) as executor:
+            return sum(executor.map(lambda documents: self.__insert_group(pool, documents), groups.values()))
+
+    def run(self):
+        start = time.perf_counter()
+        missing = [key for key in self.required if not self.settings.get(key)]
+        if missing:
+            self.timings["total"] = 0.0
+            raise ValueError(f"Faltan {', '.join(missing)} en la configuración de {self.company} en COMPANIES_FILE")
+        sqlite_path = self.get('SQLITE_PATH') if self.get('DB_BACKEND', 'odbc') == 'sqlite' else None
+        pool = None
+        try:
+            digest = ErrorDigest(int(self.get('MAIL_MAX_PER_RUN', 5))) if self.get('MAIL_DIGEST', 'S').upper() == 'S' else None
+            pool = self.__timed("conexion", ConnectionPool, self.pool_size, self.get('SERVER'), self.get('BASE_TYE'), self.get('USER'),
+                                self.get('PASSWORD'), self.get('BASE_PRODUCTIVA'), sqlite_path=sqlite_path, digest=digest)
+            web_service = self.__timed("tye", WebService, self.get('URL'), self.get('API_KEY'))
+            connection = pool.acquire()
+            try:
+                if self.get('VALIDATE_REPORTS', 'S').upper() == 'S':
+                    validator = Validator(web_service)
+                    quarantined = self.__timed("validacion", validator.validate)
+                    if quarantined:
+                        file_name = validator.save_report(self.path_log, self.company)
+                        connection.raise_email_error(f"{len(quarantined)} documentos de Tye de {self.company} en cuarentena por errores de validación. Detalle en {file_name}")
+                path_staging = self.get('PATH_STAGING')
+                if path_staging:
+                    self.__timed("staging", StagingExporter(web_service, os.path.join(path_staging, self.company), self.get('STAGING_FORMAT')).export)
+            finally:
+                pool.release(connection)
+
+            self.counts = {"anticipos": len(web_service.cash_advances), "rendiciones": len(web_service.reports)}
+            self.counts["insertados"] = self.__timed("insercion", self.__insert, pool, web_service)
+
+            connection = pool.acquire()
+            try:
+                connection.flush_errors(f"{self.company} ingesta")
+                self.__timed("novedades", send_news, connection, web_service, self.company, Profiler(False, self.path_log, "main"))
+                connection.flush_errors(f"{self.company} novedades")
+            finally:
+                pool.release(connection)
+        finally:
+            if pool:
+                pool.close()
+            self.timings["total"] = round(time.perf_counter() - start, 3)
+
+def run_companies(companies_file, retrier, path_log):
+    with open(companies_file, 'r', encoding='utf-8') as file:
+        tenants = [Tenant(settings, retrier, path_log, number) for number, settings in enumerate(json.load(file), 1)]
+    parallelism = int(os.getenv('COMPANY_PARALLELISM', len(tenants)))
+    logging.info(f"Procesando {len(tenants)} empresas con paralelismo {parallelism}.")
+
+    start = time.perf_counter()
+    errors = {}
+    with futures.ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+        pending = {executor.submit(tenant.run): tenant for tenant in tenants}
+        for future in futures.as_completed(pending):
+            tenant = pending[future]
+            try:
+                future.result()
+                logging.info(f"Empresa {tenant.company} procesada en {tenant.timings['total']:.1f}s.")
+            except Exception as e:
+                errors[tenant.company] = str(e)
+                logging.error(f"Error al procesar la empresa {tenant.company}: {e}")
+    elapsed = time.perf_counter() - start
+
+    stages = ("conexion", "tye", "validacion", "staging", "insercion", "novedades", "total")
+    logging.info("Empresa | " + " | ".join(stages) + " | documentos insertados")
+    for tenant in tenants:
+        logging.info(f"{tenant.company} | " + " | ".join(f"{tenant.timings.get(stage, 0):.1f}s" for stage in stages) + f" | {tenant.counts.get('insertados', 0)}")
+    logging.info(f"Total: {elapsed:.1f}s para {len(tenants)} empresas (suma secuencial {sum(tenant.timings.get('total', 0) for tenant in tenants):.1f}s).")
+    retrier.report()
+
+    file_name = os.path.join(path_log, datetime.datetime.now().strftime("multiempresa_%Y-%m-%d_%H.%M.%S") + ".json")
+    with open(file_name, 'w', encoding='utf-8') as file:
+        json.dump({
+            "duracion": round(elapsed, 3),
+            "empresas": {tenant.company: {"etapas": tenant.timings, **tenant.counts, "error": errors.get(tenant.company)} for tenant in tenants}
+        }, file, ensure_ascii=False, indent=2)
+
 def main():
 
     env_path = os.path.join(os.path.dirname(sys.executable), '.env')
@@ -540,45 +1407,83 @@ def main():
     path_log = os.getenv('PATH_LOG')
     log_name = os.getenv('LOG_NAME')
     logger = Logger(path_log, log_name)
+    startup_report(time.perf_counter())
+    if "--startup" in sys.argv:
+        return
+    profiler = Profiler("--profile" in sys.argv, path_log, "main", int(os.getenv('PROFILE_TOP', 20)))
 
     base = os.getenv('BASE_TYE')
     server = os.getenv('SERVER')
     username = os.getenv('USER')
     password = os.getenv('PASSWORD')
     base_prod = os.getenv('BASE_PRODUCTIVA')
-    connection = Connection(server, base, username, password, base_prod)
-
+    sqlite_path = os.getenv('SQLITE_PATH') if os.getenv('DB_BACKEND', 'odbc') == 'sqlite' else None
     api_key = os.getenv('API_KEY')
     url_tye = os.getenv('URL')
-    web_service = WebService(url_tye, api_key)
-    inserter = Inserter(connection, web_service)
+    company = os.getenv('COMPANY')
+    retrier = Retrier(int(os.getenv('DB_RETRIES', 3)), float(os.getenv('DB_RETRY_BACKOFF', 1)))
+    digest = ErrorDigest(int(os.getenv('MAIL_MAX_PER_RUN', 5))) if os.getenv('MAIL_DIGEST', 'S').upper() == 'S' else None
 
-    inserter.cashadvance_insert()
-    inserter.report_insert()
+    companies_file = os.getenv('COMPANIES_FILE')
+    if companies_file and "--daemon" not in sys.argv:
+        run_companies(companies_file, retrier, path_log)
+        imports_report()
+        logging.info(f"Fin de la ejecución main.exe ...")
+        logging.info(f"-----------------------------------")
+        return
 
-    company = os.getenv('COMPANY')
-    updater = Updater(connection, company)
-    news = updater.get_sender()
-    if news:
-        status = web_service.send_soap_request(news)
-        if status == 200:
-            updater.update_reports()
-        else:
-            connection.raise_email_error("Error al enviar la información de novedades a Tye.")
+    if "--daemon" in sys.argv:
+        pool = ConnectionPool(1, server, base, username, password, base_prod, sqlite_path=sqlite_path, digest=digest)
+        web_service = WebService(url_tye, api_key, fetch=False)
+        receipts = None
+        if os.getenv('DAEMON_RECEIPTS', 'S').upper() == 'S':
+            receipts = {
+                "api_key": api_key,
+                "path_pdf": os.getenv('PATH_PDF'),
+                "batch_size": int(os.getenv('PDF_BATCH_SIZE', 100)),
+                "flush_seconds": float(os.getenv('PDF_BATCH_SECONDS', 30)),
+                "path_failed": path_log,
+                "layout": os.getenv('RECEIPT_LAYOUT', 'tree'),
+                "timeout": float(os.getenv('PDF_TIMEOUT', 60))
+            }
+        daemon = Daemon(logger, pool, web_service, Inserter(None, web_service, retrier), company, profiler,
+                        interval=float(os.getenv('POLL_SECONDS', 300)),
+                        jitter=float(os.getenv('POLL_JITTER', 30)),
+                        quiet_hours=os.getenv('QUIET_HOURS', ''),
+                        status_file=os.getenv('STATUS_FILE', os.path.join(path_log, 'main_status.json')),
+                        receipts=receipts)
+        try:
+            daemon.run()
+        finally:
+            pool.close()
+        return
+
+    connection = Connection(server, base, username, password, base_prod, sqlite_path=sqlite_path, digest=digest)
+
+    with profiler.stage("tye"):
+        web_service = WebService(url_tye, api_key)
+
+    inserter = Inserter(connection, web_service, retrier)
+    ingest(connection, web_service, inserter, path_log, profiler)
+    connection.flush_errors("ingesta")
+    send_news(connection, web_service, company, profiler)
+    connection.flush_errors("novedades")
 
     connection.close()
 
     path_app = os.getenv('PATH_APP')
     filename = os.path.join(path_app, 'sft_rend.exe')
     
+    imports_report()
     logging.info(f"Fin de la ejecución main.exe ...")
     logging.info(f"-----------------------------------")
 
     try: 
-        script = Script(filename)
+        script = Script(filename, ["--profile"] if profiler.enabled else [])
         #script.run()
     except Exception as e:
         print(f"Error al ejecutar el script {filename}: {e}")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
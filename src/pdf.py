@@ -1,14 +1,63 @@
+import time
+START = time.perf_counter()
 import subprocess
 import logging
-import time
 import os
+import importlib
 import sys
-import pyodbc
-import requests
 import datetime
+import contextlib
 import re
+import hashlib
+import shutil
+import threading
+import json
+import multiprocessing
 from dotenv import load_dotenv 
 
+IMPORTS_ELAPSED = time.perf_counter() - START
+IMPORT_TIMES = {}
+
+class LazyModule:
+    """Imports a heavy module on first use and records how long the import took"""
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            start = time.perf_counter()
+            self.module = importlib.import_module(self.name)
+            IMPORT_TIMES[self.name] = time.perf_counter() - start
+        return getattr(self.module, attr)
+
+pyodbc = LazyModule("pyodbc")
+requests = LazyModule("requests")
+futures = LazyModule("concurrent.futures")
+
+def frozen_imports():
+    # Nunca se ejecuta: deja visibles para PyInstaller los módulos que se importan en forma diferida
+    import pyodbc
+    import requests
+    import concurrent.futures
+    import sqlite_backend
+    # Opcional: si Pillow no está instalado PyInstaller sólo lo informa como faltante
+    import PIL.Image
+    import PIL.ImageOps
+    import PIL.ImageSequence
+
+def startup_report(ready):
+    # Tiempos de arranque: importaciones, carga del .env y del log, y lanzamiento desde el script anterior de la cadena
+    message = f"Arranque en {(ready - START) * 1000:.0f} ms (importaciones {IMPORTS_ELAPSED * 1000:.0f} ms, .env y log {(ready - START - IMPORTS_ELAPSED) * 1000:.0f} ms)"
+    launched = os.getenv('TYE_LAUNCH_TS')
+    if launched:
+        message += f" - {(time.time() - float(launched)) * 1000:.0f} ms desde el lanzamiento"
+    print(message)
+
+def imports_report():
+    if IMPORT_TIMES:
+        print("Importaciones diferidas: " + ", ".join(f"{name} {elapsed * 1000:.0f} ms" for name, elapsed in IMPORT_TIMES.items()))
+
 
 class Logger:
     def __init__(self, path, log_name):
@@ -42,27 +91,124 @@ class Logger:
         sys.stdout = self.PrintToLog()
         sys.stderr = self.PrintToLog()
 
+class Profiler:
+    """Profiles each stage with cProfile and tracemalloc when the script runs with --profile"""
+    def __init__(self, enabled, path, name, top=20):
+        self.enabled = enabled
+        self.path = path
+        self.name = name
+        self.top = top
+        self.run = datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
+
+    def stage(self, stage):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.__profile(stage)
+
+    @contextlib.contextmanager
+    def __profile(self, stage):
+        import cProfile
+        import tracemalloc
+        file_name = os.path.join(self.path, f"{self.name}_{self.run}_{stage}")
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            profile.dump_stats(f"{file_name}.prof")
+            with open(f"{file_name}_mem.txt", 'w', encoding='utf-8') as file:
+                file.write(f"Etapa {stage}: {elapsed:.3f}s - memoria actual {current / 1024:.1f} KiB - pico {peak / 1024:.1f} KiB\n\n")
+                for stat in after.compare_to(before, 'lineno')[:self.top]:
+                    file.write(f"{stat}\n")
+            logging.info(f"Perfil de la etapa {stage}: {elapsed:.3f}s, pico de memoria {peak / 1024:.1f} KiB -> {file_name}.prof")
+
 class Script:
-    def __init__(self, path):
+    def __init__(self, path, args=None):
         self.path = path
+        self.args = args or []
 
     def run(self):
         try:
-            result = subprocess.run(self.path, check=True, text=True, capture_output=False)
+            env = {**os.environ, "TYE_LAUNCH_TS": str(time.time())}
+            result = subprocess.run([self.path, *self.args], check=True, text=True, capture_output=False, env=env)
         except subprocess.CalledProcessError as e:
             logging.error(f"Error al ejecutar el script {self.path}: {e}")
         
+class ErrorDigest:
+    """Buffers error e-mails, groups them by type and sends them as one digest per stage through SP_GR_PRO_MAIL"""
+    def __init__(self, max_messages=5, max_lines=30):
+        self.max_messages = max_messages
+        self.max_lines = max_lines
+        self.errors = {}
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def error_type(message):
+        # El tipo de error es el texto previo a los detalles, sin números de rendición, gasto o legajo
+        return re.sub(r"\d+", "#", message.split(":")[0]).strip()
+
+    def add(self, message, subject="Error"):
+        with self.lock:
+            error = self.errors.setdefault((subject, self.error_type(message)), {"count": 0, "example": message})
+            error["count"] += 1
+
+    def start_run(self):
+        self.sent = 0
+
+    def flush(self, connection, stage=""):
+        with self.lock:
+            errors, self.errors = self.errors, {}
+        if not errors:
+            return
+        total = sum(error["count"] for error in errors.values())
+        if self.sent >= self.max_messages:
+            print(f"Se alcanzó el límite de {self.max_messages} correos por ejecución, se omite el resumen de {total} errores.")
+            return
+        lines = [f"{error['count']} x {kind}. Ejemplo: {error['example'][:300]}" for (_, kind), error in
+                 sorted(errors.items(), key=lambda item: item[1]["count"], reverse=True)]
+        if len(lines) > self.max_lines:
+            lines = lines[:self.max_lines] + [f"... y {len(lines) - self.max_lines} tipos de error más"]
+        subjects = {subject for subject, _ in errors}
+        subject = subjects.pop() if len(subjects) == 1 else "Error"
+        try:
+            sent = connection.send_email(" | ".join(lines), f"{subject} - {stage} ({total})" if stage else f"{subject} ({total})")
+        except Exception as e:
+            print(f"Error al enviar el resumen de errores: {e}")
+            sent = False
+        if sent:
+            self.sent += 1
+            return
+        # Si el correo no salió los errores quedan en el log y se conservan para el próximo resumen
+        print(f"Resumen de errores no enviado{' (' + stage + ')' if stage else ''}: {' | '.join(lines)}")
+        with self.lock:
+            for key, error in errors.items():
+                kept = self.errors.setdefault(key, {"count": 0, "example": error["example"]})
+                kept["count"] += error["count"]
+
 class Connection:
-    def __init__(self, server, database, username, password, base_prod, driver='{ODBC Driver 17 for SQL Server}'):
+    def __init__(self, server, database, username, password, base_prod, driver='{ODBC Driver 17 for SQL Server}', sqlite_path=None, digest=None):
         self.server = server
         self.database = database
         self.username = username
         self.password = password
         self.driver = driver
+        self.sqlite_path = sqlite_path
+        self.digest = digest
         self.base_prod = base_prod
         self.connection = self.connect()
 
     def connect(self):
+        if self.sqlite_path:
+            return self.connect_sqlite()
         conn_str = f'DSN={self.database};UID={self.username};PWD={self.password}'
         #conn_str = f'SERVER={self.server};DATABASE={self.database};UID={self.username};PWD={self.password};DRIVER={self.driver}'
         try:
@@ -73,6 +219,13 @@ class Connection:
             print(f"Error al conectar a SQL Server: {e}")
             raise
 
+    def connect_sqlite(self):
+        # Backend local de desarrollo que emula los procedimientos almacenados sobre SQLite
+        import sqlite_backend
+        conn = sqlite_backend.connect(self.sqlite_path)
+        print(f"Conexión exitosa a {self.sqlite_path} (SQLite).")
+        return conn
+
     def run_query(self, query, return_data=True):
         with self.connection.cursor() as cursor:
             try:
@@ -85,12 +238,167 @@ class Connection:
                 self.connection.rollback()
 
     def raise_email_error(self, message, subject="Error"):
+        if self.digest is not None:
+            self.digest.add(message, subject)
+        else:
+            self.send_email(message, subject)
+
+    def send_email(self, message, subject="Error"):
         query = f"""EXEC {self.base_prod}.DBO.SP_GR_PRO_MAIL @CODPER = 'ENVTYE', @DIREML = '', @DIRECC = '', @DIRCCO = '', @VARIABLES = '<ERROR>|{message.replace("'", " ")}#<ASUNTO>|{subject}', @ADJUNTOS = ''"""
-        self.run_query(query, False)
+        # run_query no propaga los errores: se ejecuta aparte para saber si el correo se registró
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(query)
+            self.connection.commit()
+            return True
+        except Exception as e:
+            self.connection.rollback()
+            print(f"Error al enviar el correo de errores: {e}")
+            return False
+    
+    def flush_errors(self, stage=""):
+        if self.digest is not None:
+            self.digest.flush(self, stage)
     
     def close(self):
         self.connection.close()
 
+class ReceiptStore:
+    """Decides where each receipt is saved.
+
+    The "tree" layout is the original PATH_PDF/ctacte/period/nromov/nroitm/. The "sharded" layout
+    spreads files over two levels of 256 hash directories and keeps an append-only index
+    (index.tsv: key, relative path, timestamp) to find a receipt by its document key.
+    """
+    INDEX_NAME = "index.tsv"
+
+    def __init__(self, path, layout="tree"):
+        if layout not in ("tree", "sharded"):
+            raise ValueError(f"Estructura de comprobantes desconocida: {layout}")
+        self.path = path
+        self.layout = layout
+        self.index_path = os.path.join(path, self.INDEX_NAME)
+        self.created = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(ctacte, period, nromov, nroitm):
+        # Sin espacios: los campos char de SQL vienen con relleno y Windows no los conserva en los nombres de carpeta
+        return "_".join(str(field).strip() for field in (ctacte, period, nromov, nroitm))
+
+    def shard(self, ctacte, period, nromov, nroitm):
+        digest = hashlib.sha1(self.key(ctacte, period, nromov, nroitm).encode()).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:4])
+
+    def folder(self, ctacte, period, nromov, nroitm):
+        if self.layout == "tree":
+            folder_path = os.path.join(self.path, f'{ctacte}', f'{period}', f'{nromov}', f'{nroitm}')
+        else:
+            folder_path = self.shard(ctacte, period, nromov, nroitm)
+        # Cada carpeta se crea una sola vez por ejecución
+        if folder_path not in self.created:
+            os.makedirs(folder_path, exist_ok=True)
+            self.created.add(folder_path)
+        return folder_path
+
+    def record(self, key, file_path):
+        if self.layout != "sharded":
+            return
+        with self.lock:
+            with open(self.index_path, 'a', encoding='utf-8') as index:
+                index.write(f"{key}\t{os.path.relpath(file_path, self.path)}\t{datetime.datetime.now():%Y-%m-%d %H:%M:%S}\n")
+
+    def load_index(self):
+        # Si una clave aparece varias veces vale la última línea
+        index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding='utf-8') as file:
+                for line in file:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) >= 2:
+                        index[fields[0]] = os.path.join(self.path, fields[1])
+        return index
+
+    def legacy_receipts(self):
+        # La estructura anterior guarda los archivos a profundidad 4 (ctacte/periodo/nromov/nroitm) y la de hash a profundidad 2
+        for folder_path, folders, files in os.walk(self.path):
+            relative = os.path.relpath(folder_path, self.path)
+            parts = [] if relative == os.curdir else relative.split(os.sep)
+            if parts and parts[0].startswith('_'):
+                folders[:] = []
+            elif len(parts) == 2 and files:
+                folders[:] = []
+            elif len(parts) == 4:
+                folders[:] = []
+                for file_name in files:
+                    yield parts, os.path.join(folder_path, file_name)
+
+    def migrate(self, conn, query, dry_run=False, batch_size=500):
+        """Moves the receipts of the tree layout into the sharded one, rewriting OLEOLE in SQL before the originals are deleted"""
+        pending = [(parts, old_path, os.path.join(self.shard(*parts), os.path.basename(old_path))) for parts, old_path in self.legacy_receipts()]
+        if dry_run:
+            print(f"Comprobantes a migrar: {len(pending)}")
+            return pending
+
+        moved = []
+        unmatched = []
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            copied = []
+            updated = []
+            cursor = conn.connection.cursor()
+            try:
+                # Primero se copian los archivos; los originales se borran sólo si SQL ya apunta a las rutas nuevas
+                for parts, old_path, new_path in batch:
+                    self.folder(*parts)
+                    shutil.copy2(old_path, new_path)
+                    copied.append(new_path)
+                    cursor.execute(query, new_path, old_path)
+                    updated.append(cursor.rowcount > 0)
+                conn.connection.commit()
+            except Exception as e:
+                conn.connection.rollback()
+                for new_path in copied:
+                    with contextlib.suppress(OSError):
+                        os.remove(new_path)
+                print(f"Error al migrar el lote de {len(batch)} comprobantes, se detiene la migración: {e}")
+                conn.raise_email_error(f"Error al migrar el lote de {len(batch)} comprobantes: {e}.")
+                break
+            finally:
+                cursor.close()
+            for (parts, old_path, new_path), matched in zip(batch, updated):
+                if matched:
+                    self.record(self.key(*parts), new_path)
+                    os.remove(old_path)
+                    moved.append((old_path, new_path))
+                else:
+                    # Ninguna fila de SQL tenía la ruta anterior: se conserva el original y la copia queda sin usar
+                    unmatched.append((old_path, new_path))
+            print(f"Lote de {len(batch)} comprobantes: {sum(updated)} migrados, {len(batch) - sum(updated)} sin ruta en SQL.")
+
+        # Se eliminan las carpetas de la estructura anterior que quedaron vacías
+        folders = set()
+        for old_path, _ in moved:
+            folder_path = os.path.dirname(old_path)
+            for _ in range(4):
+                folders.add(folder_path)
+                folder_path = os.path.dirname(folder_path)
+        for folder_path in sorted(folders, key=len, reverse=True):
+            with contextlib.suppress(OSError):
+                os.rmdir(folder_path)
+
+        mapping = os.path.join(self.path, f"migracion_comprobantes_{datetime.datetime.now():%Y%m%d_%H%M%S}.csv")
+        if moved or unmatched:
+            with open(mapping, 'w', encoding='utf-8') as file:
+                file.write("ruta_anterior;ruta_nueva;estado\n")
+                file.writelines(f"{old};{new};migrado\n" for old, new in moved)
+                file.writelines(f"{old};{new};sin ruta en SQL\n" for old, new in unmatched)
+        print(f"Comprobantes migrados: {len(moved)} de {len(pending)} - Sin ruta en SQL (se conservan): {len(unmatched)}"
+              + (f" - Detalle en {mapping}" if moved or unmatched else ""))
+        if unmatched:
+            conn.raise_email_error(f"{len(unmatched)} comprobantes no se migraron porque ninguna ruta en SQL coincide con la anterior. Detalle en {mapping}.")
+        return moved
+
 class Item:
     def __init__(self, conn, inicia, ctacte, period, nromov, nroitm, oletye, tipren, nrotye):
         self.inicia = inicia
@@ -103,15 +411,26 @@ class Item:
         self.nrotye = nrotye
         self.conn = conn
         self.file_path = ""
+        self.error = ""
 
     
-    def save_pdf(self, apikey, path_pdf):
+    def save_pdf(self, apikey, store, timeout=60):
         headers = {
         "X-Api-key": apikey
         }
-        
-        response = requests.get(self.oletye, headers=headers)
-        if response.status_code == 200:
+
+        try:
+            response = requests.get(self.oletye, headers=headers, timeout=timeout)
+        except Exception as e:
+            # Errores de conexión o tiempo agotado: el comprobante queda pendiente de reintento
+            self.error = str(e)
+            print(f"Error al descargar el archivo del gasto {self.ctacte} {self.period} {self.nromov} {self.nroitm}: {e}")
+            return False
+        if response.status_code != 200:
+            self.error = f"HTTP {response.status_code}"
+            print(f"Error al descargar el archivo del gasto {self.ctacte} {self.period} {self.nromov} {self.nroitm}: {self.error}")
+            return False
+        else:
             try:
                 # Extrae la extensión del archivo del enlace
                 extension_match = re.search(r'\.([a-zA-Z0-9]+)$', self.oletye)
@@ -121,34 +440,233 @@ class Item:
                     extension = "unknown"  # Si no se puede determinar la extensión
 
                 file_name = f"{self.ctacte}_{self.period}_{self.nromov}_{self.nroitm}.{extension}"
-                folder_path = os.path.join(path_pdf, f'{self.ctacte}', f'{self.period}', f'{self.nromov}', f'{self.nroitm}')
+                folder_path = store.folder(self.ctacte, self.period, self.nromov, self.nroitm)
+                file_path = os.path.join(folder_path, file_name)
 
-                if not os.path.exists(folder_path):
-                    os.makedirs(folder_path)
-                self.file_path = os.path.join(folder_path, file_name)
-
-                if not os.path.exists(self.file_path):
-                    with open(self.file_path, 'wb') as file:
+                if not os.path.exists(file_path):
+                    with open(file_path, 'wb') as file:
                         file.write(response.content)
-                    print(f"Archivo guardado como {self.file_path}")
+                    print(f"Archivo guardado como {file_path}")
+                self.file_path = file_path
+                return True
             except Exception as e:
+                self.error = str(e)
                 print(f"Error al guardar el archivo del gasto {self.ctacte} {self.period} {self.nromov} {self.nroitm}: {e}")
                 self.conn.raise_email_error(f"Error al guardar el archivo del gasto {self.ctacte} {self.period} {self.nromov} {self.nroitm}: {e}.")       
-                
-    def update_pdf(self):
-        self.conn.run_query(f"""
-                EXEC SP_CO_REND_UPDATE_OLEOLE
-                    @FLPATH = '{self.file_path}'
-                    , @TIPREN = {self.tipren}
-                    , @NROTYE = {self.nrotye}
-                    , @NROITM = {self.nroitm}
-                    """, False)
+                return False
+
+class OleoleWriter:
+    """Collects the paths of downloaded receipts and writes them to SQL in batches"""
+    query = """EXEC SP_CO_REND_UPDATE_OLEOLE @FLPATH = ?, @TIPREN = ?, @NROTYE = ?, @NROITM = ?"""
+
+    def __init__(self, conn, batch_size=100, flush_seconds=30):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.failed = []
+        self.written = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, item):
+        self.pending.append(item)
+        if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def fail(self, item):
+        self.failed.append({
+            "inicia": item.inicia,
+            "ctacte": item.ctacte,
+            "period": item.period,
+            "nromov": item.nromov,
+            "nroitm": item.nroitm,
+            "oletye": item.oletye,
+            "tipren": item.tipren,
+            "nrotye": item.nrotye,
+            "flpath": item.file_path,
+            "error": item.error
+        })
+
+    def __write(self, batch):
+        cursor = self.conn.connection.cursor()
+        try:
+            cursor.fast_executemany = True
+            cursor.executemany(self.query, [(item.file_path, item.tipren, item.nrotye, item.nroitm) for item in batch])
+            self.conn.connection.commit()
+        except Exception:
+            self.conn.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        for attempt in (1, 2):
+            try:
+                self.__write(batch)
+                self.written += len(batch)
+                print(f"Lote de {len(batch)} rutas de comprobantes actualizado en SQL.")
+                return
+            except Exception as e:
+                print(f"Error al actualizar el lote de {len(batch)} rutas de comprobantes (intento {attempt}): {e}")
+                error = e
+        # Los archivos ya están descargados: el lote queda registrado para reintentar la grabación de las rutas
+        for item in batch:
+            item.error = f"SQL: {error}"
+            self.fail(item)
+        self.conn.raise_email_error(f"Error al actualizar el lote de {len(batch)} rutas de comprobantes: {error}.")
+
+    def save_failed(self, path):
+        if not self.failed or not path:
+            return
+        if not os.path.exists(path):
+            os.makedirs(path)
+        file_name = os.path.join(path, datetime.datetime.now().strftime("oleole_pendientes_%Y-%m-%d.jsonl"))
+        with open(file_name, 'a', encoding='utf-8') as file:
+            for failed in self.failed:
+                file.write(json.dumps(failed, default=str) + "\n")
+        print(f"{len(self.failed)} comprobantes pendientes de reintento registrados en {file_name}")
+
+RECEIPT_TYPES = (
+    (b"%PDF", "pdf"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"II*\x00", "tif"),
+    (b"MM\x00*", "tif"),
+    (b"BM", "bmp")
+)
+
+def detect_receipt_type(head):
+    for magic, kind in RECEIPT_TYPES:
+        if head.startswith(magic):
+            return kind
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def normalize_receipt(file_path, max_side, quality, thumbnail_path, thumbnail_size):
+    """Runs in a worker process: detects the real file type and turns images into a downsampled, recompressed PDF"""
+    result = {"path": file_path, "before": os.path.getsize(file_path), "kind": None, "thumbnail": None}
+    with open(file_path, 'rb') as file:
+        result["kind"] = detect_receipt_type(file.read(16))
+    new_path = f"{os.path.splitext(file_path)[0]}.pdf"
+
+    if result["kind"] == "pdf":
+        if new_path != file_path:
+            os.replace(file_path, new_path)
+    elif result["kind"] is not None:
+        from PIL import Image, ImageOps, ImageSequence
+        temp_path = f"{new_path}.tmp"
+        with Image.open(file_path) as image:
+            # Los TIFF y GIF escaneados pueden tener varias páginas: se convierte cada cuadro
+            pages = []
+            for frame in ImageSequence.Iterator(image):
+                page = ImageOps.exif_transpose(frame)
+                page = page.convert("RGB") if page.mode not in ("RGB", "L") else page.copy()
+                page.thumbnail((max_side, max_side))
+                pages.append(page)
+            pages[0].save(temp_path, "PDF", resolution=150, quality=quality, save_all=True, append_images=pages[1:])
+        with open(temp_path, 'rb') as file:
+            written = len(re.findall(rb"/Type\s*/Page\b", file.read()))
+        if written != len(pages):
+            os.remove(temp_path)
+            raise ValueError(f"el PDF tiene {written} páginas y la imagen {len(pages)}")
+        os.replace(temp_path, new_path)
+        if thumbnail_path:
+            thumbnail_file = os.path.join(thumbnail_path, f"{os.path.splitext(os.path.basename(file_path))[0]}.jpg")
+            if not os.path.exists(thumbnail_file):
+                pages[0].thumbnail((thumbnail_size, thumbnail_size))
+                pages[0].save(thumbnail_file, "JPEG", quality=70)
+            result["thumbnail"] = thumbnail_file
+        # El original se borra sólo después de verificar la cantidad de páginas
+        if new_path != file_path:
+            os.remove(file_path)
+    else:
+        new_path = file_path
+
+    result["new_path"] = new_path
+    result["after"] = os.path.getsize(new_path)
+    return result
+
+class ReceiptNormalizer:
+    """Normalizes downloaded receipts into compact PDFs in a process pool and keeps before/after size metrics"""
+    def __init__(self, workers=None, max_side=1600, quality=75, thumbnail_path=None, thumbnail_size=256):
+        self.max_side = max_side
+        self.quality = quality
+        self.thumbnail_path = thumbnail_path
+        self.thumbnail_size = thumbnail_size
+        if thumbnail_path and not os.path.exists(thumbnail_path):
+            os.makedirs(thumbnail_path)
+        self.executor = futures.ProcessPoolExecutor(max_workers=workers)
+        self.pending = {}
+        self.kinds = {}
+        self.before = 0
+        self.after = 0
+        self.errors = 0
+        self.start = time.perf_counter()
+
+    def submit(self, item):
+        future = self.executor.submit(normalize_receipt, item.file_path, self.max_side, self.quality, self.thumbnail_path, self.thumbnail_size)
+        self.pending[future] = item
+
+    def __collect(self, future):
+        item = self.pending.pop(future)
+        try:
+            result = future.result()
+        except Exception as e:
+            # Si no se puede normalizar se conserva el archivo descargado
+            self.errors += 1
+            print(f"Error al normalizar el comprobante {item.file_path}: {e}")
+            return item
+        item.file_path = result["new_path"]
+        self.kinds[result["kind"] or "desconocido"] = self.kinds.get(result["kind"] or "desconocido", 0) + 1
+        self.before += result["before"]
+        self.after += result["after"]
+        return item
+
+    def completed(self):
+        return [self.__collect(future) for future in list(self.pending) if future.done()]
+
+    def wait(self):
+        return [self.__collect(future) for future in futures.as_completed(list(self.pending))]
+
+    def close(self):
+        self.executor.shutdown()
+        saved = 100 * (1 - self.after / self.before) if self.before else 0
+        kinds = ", ".join(f"{kind} {count}" for kind, count in sorted(self.kinds.items()))
+        print(f"Comprobantes normalizados: {sum(self.kinds.values())} ({kinds}) - Errores: {self.errors} - "
+              f"{self.before / 1048576:.1f} MB -> {self.after / 1048576:.1f} MB ({saved:.0f}% menos) en {time.perf_counter() - self.start:.1f}s")
+
+def build_normalizer(path_pdf):
+    if os.getenv('RECEIPT_NORMALIZE', 'N').upper() != 'S':
+        return None
+    try:
+        import PIL
+    except ImportError:
+        print("No está instalado Pillow, se omite la normalización de comprobantes.")
+        return None
+    return ReceiptNormalizer(int(os.getenv('RECEIPT_WORKERS', os.cpu_count() or 1)),
+                             int(os.getenv('RECEIPT_MAX_SIDE', 1600)),
+                             int(os.getenv('RECEIPT_QUALITY', 75)),
+                             os.getenv('PATH_THUMBNAILS', os.path.join(path_pdf, '_miniaturas')),
+                             int(os.getenv('RECEIPT_THUMBNAIL_SIZE', 256)))
 
 class Pdf:
-    def __init__(self, conn, api_key, path_pdf):
+    def __init__(self, conn, api_key, path_pdf, batch_size=100, flush_seconds=30, path_failed=None, normalizer=None, layout="tree", timeout=60):
         self.conn = conn
         self.api_key = api_key
         self.path_pdf = path_pdf
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.path_failed = path_failed
+        self.normalizer = normalizer
+        self.timeout = timeout
+        self.store = ReceiptStore(path_pdf, layout)
         self.items = self.get_pdf_objects()
 
     def get_pdf_objects(self):
@@ -158,10 +676,33 @@ class Pdf:
             item_pdf_obj = [Item(self.conn, *item) for item in item_sql]
         return item_pdf_obj
     
+    def __saved(self, writer, item):
+        self.store.record(self.store.key(item.ctacte, item.period, item.nromov, item.nroitm), item.file_path)
+        writer.add(item)
+
     def update_pdfs(self):
-        for item in self.items:
-            item.save_pdf(self.api_key, self.path_pdf)
-            item.update_pdf()
+        writer = OleoleWriter(self.conn, self.batch_size, self.flush_seconds)
+        try:
+            for item in self.items:
+                if not item.save_pdf(self.api_key, self.store, self.timeout):
+                    writer.fail(item)
+                elif self.normalizer:
+                    # La normalización corre en paralelo con las descargas siguientes
+                    self.normalizer.submit(item)
+                else:
+                    self.__saved(writer, item)
+                if self.normalizer:
+                    for normalized in self.normalizer.completed():
+                        self.__saved(writer, normalized)
+            if self.normalizer:
+                for normalized in self.normalizer.wait():
+                    self.__saved(writer, normalized)
+        finally:
+            if self.normalizer:
+                self.normalizer.close()
+            writer.flush()
+            writer.save_failed(self.path_failed)
+        print(f"Comprobantes actualizados: {writer.written} - Pendientes de reintento: {len(writer.failed)}")
 
 def main():
 
@@ -171,39 +712,64 @@ def main():
     path_log = os.getenv('PATH_LOG')
     log_name = os.getenv('LOG_NAME')
     logger = Logger(path_log, log_name)
+    startup_report(time.perf_counter())
+    if "--startup" in sys.argv:
+        return
+    profiler = Profiler("--profile" in sys.argv, path_log, "pdf", int(os.getenv('PROFILE_TOP', 20)))
+    layout = os.getenv('RECEIPT_LAYOUT', 'tree')
 
     base = os.getenv('BASE_TYE')
     server = os.getenv('SERVER')
     username = os.getenv('USER')
     password = os.getenv('PASSWORD')
     base_prod = os.getenv('BASE_PRODUCTIVA')
-    conn = Connection(server, base, username, password, base_prod)
+    sqlite_path = os.getenv('SQLITE_PATH') if os.getenv('DB_BACKEND', 'odbc') == 'sqlite' else None
+    digest = ErrorDigest(int(os.getenv('MAIL_MAX_PER_RUN', 5))) if os.getenv('MAIL_DIGEST', 'S').upper() == 'S' else None
+    conn = Connection(server, base, username, password, base_prod, sqlite_path=sqlite_path, digest=digest)
     path_pdf = os.getenv('PATH_PDF')
 
+    if "--migrate" in sys.argv:
+        try:
+            ReceiptStore(path_pdf, "sharded").migrate(conn, os.getenv('RECEIPT_MIGRATE_QUERY', 'UPDATE CORRTI SET OLEOLE = ? WHERE OLEOLE = ?'),
+                                                      dry_run="--dry-run" in sys.argv)
+        finally:
+            conn.flush_errors("migracion")
+            conn.close()
+        return
+
     api_key = os.getenv('API_KEY')
+    batch_size = int(os.getenv('PDF_BATCH_SIZE', 100))
+    flush_seconds = float(os.getenv('PDF_BATCH_SECONDS', 30))
+
+    normalizer = build_normalizer(path_pdf)
 
     try:
-        pdfs = Pdf(conn, api_key, path_pdf)
-        pdfs.get_pdf_objects()
-        pdfs.update_pdfs()
+        with profiler.stage("consulta"):
+            pdfs = Pdf(conn, api_key, path_pdf, batch_size, flush_seconds, path_log, normalizer, layout, float(os.getenv('PDF_TIMEOUT', 60)))
+            pdfs.get_pdf_objects()
+        with profiler.stage("comprobantes"):
+            pdfs.update_pdfs()
     except Exception as e:
         print(f"Error al ejecutar la inserción de datos en Softland: {e}")
         conn.connection.rollback()
     finally:
+        conn.flush_errors("comprobantes")
         conn.close()
 
 
     path_app = os.getenv('PATH_APP')
     filename = os.path.join(path_app, 'sft_precar.exe')
     
+    imports_report()
     print(f"Fin de la ejecución pdf.exe ...")
     print(f"-----------------------------------")
 
     try: 
-        script = Script(filename)
+        script = Script(filename, ["--profile"] if profiler.enabled else [])
         script.run()
     except Exception as e:
         print(f"Error al ejecutar el script {filename}: {e}")
     
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
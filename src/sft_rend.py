@@ -1,11 +1,55 @@
+import time
+START = time.perf_counter()
 import subprocess
 import logging
-import time
 import os
+import importlib
 import sys
-import pyodbc
+import queue
 from dotenv import load_dotenv
 import datetime
+import contextlib
+import random
+import threading
+import re
+
+IMPORTS_ELAPSED = time.perf_counter() - START
+IMPORT_TIMES = {}
+
+class LazyModule:
+    """Imports a heavy module on first use and records how long the import took"""
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            start = time.perf_counter()
+            self.module = importlib.import_module(self.name)
+            IMPORT_TIMES[self.name] = time.perf_counter() - start
+        return getattr(self.module, attr)
+
+pyodbc = LazyModule("pyodbc")
+futures = LazyModule("concurrent.futures")
+
+def frozen_imports():
+    # Nunca se ejecuta: deja visibles para PyInstaller los módulos que se importan en forma diferida
+    import pyodbc
+    import concurrent.futures
+    import sqlite_backend
+
+def startup_report(ready):
+    # Tiempos de arranque: importaciones, carga del .env y del log, y lanzamiento desde el script anterior de la cadena
+    message = f"Arranque en {(ready - START) * 1000:.0f} ms (importaciones {IMPORTS_ELAPSED * 1000:.0f} ms, .env y log {(ready - START - IMPORTS_ELAPSED) * 1000:.0f} ms)"
+    launched = os.getenv('TYE_LAUNCH_TS')
+    if launched:
+        message += f" - {(time.time() - float(launched)) * 1000:.0f} ms desde el lanzamiento"
+    print(message)
+
+def imports_report():
+    if IMPORT_TIMES:
+        print("Importaciones diferidas: " + ", ".join(f"{name} {elapsed * 1000:.0f} ms" for name, elapsed in IMPORT_TIMES.items()))
+
 
 class Logger:
     def __init__(self, path, log_name):
@@ -39,27 +83,103 @@ class Logger:
         sys.stdout = self.PrintToLog()
         sys.stderr = self.PrintToLog()
 
+class Profiler:
+    """Profiles each stage with cProfile and tracemalloc when the script runs with --profile"""
+    def __init__(self, enabled, path, name, top=20):
+        self.enabled = enabled
+        self.path = path
+        self.name = name
+        self.top = top
+        self.run = datetime.datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
+        self.thread_profiles = []
+        self.lock = threading.Lock()
+
+    def stage(self, stage):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.__profile(stage)
+
+    def thread(self):
+        # Hasta Python 3.11 cProfile sólo mide el hilo que lo activa: cada hilo de trabajo lleva su propio perfil y se suma al
+        # de la etapa. Desde 3.12 no se admite un segundo perfilador activo: los hilos corren sin perfil propio
+        if not self.enabled or sys.version_info >= (3, 12):
+            return contextlib.nullcontext()
+        return self.__profile_thread()
+
+    @contextlib.contextmanager
+    def __profile_thread(self):
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # El perfilado nunca debe impedir que se procese la partición
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                self.thread_profiles.append(profile)
+
+    @contextlib.contextmanager
+    def __profile(self, stage):
+        import cProfile
+        import tracemalloc
+        file_name = os.path.join(self.path, f"{self.name}_{self.run}_{stage}")
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            import pstats
+            stats = pstats.Stats(profile)
+            with self.lock:
+                thread_profiles, self.thread_profiles = self.thread_profiles, []
+            for thread_profile in thread_profiles:
+                stats.add(thread_profile)
+            stats.dump_stats(f"{file_name}.prof")
+            with open(f"{file_name}_mem.txt", 'w', encoding='utf-8') as file:
+                file.write(f"Etapa {stage}: {elapsed:.3f}s - memoria actual {current / 1024:.1f} KiB - pico {peak / 1024:.1f} KiB\n\n")
+                for stat in after.compare_to(before, 'lineno')[:self.top]:
+                    file.write(f"{stat}\n")
+            logging.info(f"Perfil de la etapa {stage}: {elapsed:.3f}s, pico de memoria {peak / 1024:.1f} KiB -> {file_name}.prof")
+
 class Script:
-    def __init__(self, path):
+    def __init__(self, path, args=None):
         self.path = path
+        self.args = args or []
 
     def run(self):
         try:
-            result = subprocess.run(self.path, check=True, text=True, capture_output=False)
+            env = {**os.environ, "TYE_LAUNCH_TS": str(time.time())}
+            result = subprocess.run([self.path, *self.args], check=True, text=True, capture_output=False, env=env)
         except subprocess.CalledProcessError as e:
             logging.error(f"Error al ejecutar el script {self.path}: {e}")
         
 class Connection:
-    def __init__(self, server, database, username, password, driver='{ODBC Driver 17 for SQL Server}', timeout=1200):
+    def __init__(self, server, database, username, password, driver='{ODBC Driver 17 for SQL Server}', timeout=1200, sqlite_path=None):
         self.server = server
         self.database = database
         self.username = username
         self.password = password
         self.driver = driver
+        self.sqlite_path = sqlite_path
         self.timeout = timeout
         self.connection = self.connect()
 
     def connect(self):
+        if self.sqlite_path:
+            return self.connect_sqlite()
         conn_str = (
             f'DSN={self.database};'
             f'UID={self.username};'
@@ -77,10 +197,17 @@ class Connection:
             print(f"Error al conectar a SQL Server: {e}")
             raise
 
-    def run_query(self, query, return_data=True):
+    def connect_sqlite(self):
+        # Backend local de desarrollo que emula los procedimientos almacenados sobre SQLite
+        import sqlite_backend
+        conn = sqlite_backend.connect(self.sqlite_path)
+        print(f"Conexión exitosa a {self.sqlite_path} (SQLite).")
+        return conn
+
+    def run_query(self, query, return_data=True, params=()):
         with self.connection.cursor() as cursor:
             try:
-                cursor.execute(query.replace("\n", " "))
+                cursor.execute(query.replace("\n", " "), *params)
                 while cursor.nextset():
                     pass
                 if return_data:
@@ -98,6 +225,153 @@ class Connection:
     def close(self):
         self.connection.close()
 
+class Retrier:
+    """Retries database operations that fail with a deadlock or a lock/query timeout, with jittered exponential backoff"""
+    sqlstates = {"40001", "HYT00", "HYT01"}
+    native_codes = {1205, 1222, -2}
+
+    def __init__(self, retries=3, backoff=1.0, max_backoff=30.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.attempts = {}
+        self.recovered = {}
+        self.exhausted = {}
+        self.lock = threading.Lock()
+
+    def __count(self, counter, kind):
+        with self.lock:
+            counter[kind] = counter.get(kind, 0) + 1
+
+    def is_retryable(self, error):
+        args = getattr(error, "args", ())
+        sqlstate = args[0] if args and isinstance(args[0], str) else ""
+        # Una violación de integridad nunca se resuelve reintentando, aunque el valor de la clave parezca un código nativo
+        if sqlstate == "23000":
+            return False
+        message = " ".join(str(arg) for arg in args[1:]) if len(args) > 1 else str(error)
+        # El código nativo es el sufijo del driver: "... (1205) (SQLExecDirectW)" o "(1205)" al final del mensaje
+        codes = {int(code) for code in re.findall(r"\((-?\d+)\)\s*(?:\(SQL\w+\)|$)", message)}
+        return sqlstate in self.sqlstates or bool(codes & self.native_codes)
+
+    def run(self, kind, label, operation, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                result = operation(*args, **kwargs)
+                if attempt:
+                    self.__count(self.recovered, kind)
+                return result
+            except Exception as e:
+                if not self.is_retryable(e):
+                    raise
+                if attempt >= self.retries:
+                    self.__count(self.exhausted, kind)
+                    raise
+                attempt += 1
+                self.__count(self.attempts, kind)
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                print(f"Reintento {attempt}/{self.retries} de {kind} {label} en {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    def report(self):
+        for kind in sorted(set(self.attempts) | set(self.exhausted)):
+            print(f"Reintentos {kind}: {self.attempts.get(kind, 0)} - Recuperados: {self.recovered.get(kind, 0)} - Agotados: {self.exhausted.get(kind, 0)}")
+
+class ConnectionPool:
+    def __init__(self, size, *args, **kwargs):
+        self.size = size
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(Connection(*args, **kwargs))
+
+    def acquire(self):
+        return self.connections.get()
+
+    def release(self, connection):
+        self.connections.put(connection)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+class Partitioner:
+    """Runs SP_CO_PRO_RENDICIONES_TYE once per pending partition over a pool of connections"""
+    def __init__(self, connection, pool, partitions_query, retrier, procedure="SP_CO_PRO_RENDICIONES_TYE", profiler=None):
+        self.connection = connection
+        self.pool = pool
+        self.partitions_query = partitions_query
+        self.procedure = procedure
+        self.retrier = retrier
+        self.profiler = profiler
+        self.partitions = self.__get_partitions()
+        self.results = []
+
+    def __get_partitions(self):
+        # Cada columna devuelta por la consulta de particiones se pasa como parámetro al procedimiento
+        with self.connection.connection.cursor() as cursor:
+            cursor.execute(self.partitions_query)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    @staticmethod
+    def describe(partition):
+        return ", ".join(f"{key}={value}" for key, value in partition.items())
+
+    def __build_query(self, partition):
+        # Los valores van como parámetros para que fechas y textos lleguen con su tipo y sin escapar
+        params = ", ".join(f"@{key} = ?" for key in partition)
+        return f"EXEC {self.procedure} {params}", list(partition.values())
+
+    def __run_partition(self, partition):
+        connection = self.pool.acquire()
+        start = time.perf_counter()
+        try:
+            with self.profiler.thread() if self.profiler else contextlib.nullcontext():
+                query, params = self.__build_query(partition)
+                self.retrier.run(self.procedure, self.describe(partition), connection.run_query, query, return_data=False, params=params)
+            return partition, time.perf_counter() - start, None
+        except Exception as e:
+            return partition, time.perf_counter() - start, e
+        finally:
+            self.pool.release(connection)
+
+    def run(self):
+        total = len(self.partitions)
+        print(f"Particiones pendientes: {total} - Paralelismo: {self.pool.size}")
+        start = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            pending_futures = [executor.submit(self.__run_partition, partition) for partition in self.partitions]
+            for done, future in enumerate(futures.as_completed(pending_futures), 1):
+                partition, elapsed, error = future.result()
+                self.results.append((partition, elapsed, error))
+                if error is None:
+                    print(f"[{done}/{total}] Partición {self.describe(partition)} procesada en {elapsed:.1f}s.")
+                else:
+                    print(f"[{done}/{total}] Error en la partición {self.describe(partition)} tras {elapsed:.1f}s: {error}")
+        failed = self.failed()
+        print(f"Particiones procesadas: {total - len(failed)}/{total} en {time.perf_counter() - start:.1f}s.")
+        return failed
+
+    def failed(self):
+        return [(partition, error) for partition, _, error in self.results if error is not None]
+
+def run_partitioned(connection, retrier, server, base, username, password, timeout, profiler=None):
+    partitions_query = os.getenv('REND_PARTITIONS_QUERY', 'EXEC SP_CO_REND_GET_PARTICIONES_TYE')
+    parallelism = int(os.getenv('REND_PARALLELISM', 4))
+    pool = ConnectionPool(parallelism, server, base, username, password, timeout=timeout, sqlite_path=connection.sqlite_path)
+    try:
+        partitioner = Partitioner(connection, pool, partitions_query, retrier, profiler=profiler)
+        failed = partitioner.run()
+    finally:
+        pool.close()
+    if failed:
+        errors = " | ".join(f"{Partitioner.describe(partition)}: {error}" for partition, error in failed)
+        print(f"Error al ejecutar la inserción de datos en Softland en {len(failed)} particiones: {errors}")
+        connection.raise_email_error(f"Error al ejecutar la inserción de datos en Softland en {len(failed)} particiones: {errors}")
+    else:
+        print("Se ejecutó la inserción de datos en Softland por particiones.")
+
 def main():
     env_path = os.path.join(os.path.dirname(sys.executable), '.env')
     load_dotenv(env_path)
@@ -105,30 +379,43 @@ def main():
     path_log = os.getenv('PATH_LOG')
     log_name = os.getenv('LOG_NAME')
     logger = Logger(path_log, log_name)
+    startup_report(time.perf_counter())
+    if "--startup" in sys.argv:
+        return
+    profiler = Profiler("--profile" in sys.argv, path_log, "sft_rend", int(os.getenv('PROFILE_TOP', 20)))
 
     base = os.getenv('BASE_PRODUCTIVA')
     server = os.getenv('SERVER')
     username = os.getenv('USER')
     password = os.getenv('PASSWORD')
-    connection = Connection(server, base, username, password, timeout=1200)
+    sqlite_path = os.getenv('SQLITE_PATH') if os.getenv('DB_BACKEND', 'odbc') == 'sqlite' else None
+    connection = Connection(server, base, username, password, timeout=1200, sqlite_path=sqlite_path)
+    partitioned = os.getenv('REND_PARTITIONED', 'N').upper() == 'S'
+    retrier = Retrier(int(os.getenv('DB_RETRIES', 3)), float(os.getenv('DB_RETRY_BACKOFF', 1)))
 
     try:
-        connection.run_query(f"EXEC SP_CO_PRO_RENDICIONES_TYE", return_data=False)
-        print("Se ejecutó la inserción de datos en Softland.")
+        with profiler.stage("softland"):
+            if partitioned:
+                run_partitioned(connection, retrier, server, base, username, password, timeout=1200, profiler=profiler)
+            else:
+                retrier.run("SP_CO_PRO_RENDICIONES_TYE", "", connection.run_query, f"EXEC SP_CO_PRO_RENDICIONES_TYE", return_data=False)
+                print("Se ejecutó la inserción de datos en Softland.")
     except Exception as e:
         print(f"Error al ejecutar la inserción de datos en Softland: {e}")
         connection.raise_email_error(f"Error al ejecutar la inserción de datos en Softland: {e}")
     finally:
+        retrier.report()
         connection.close()
 
     path_app = os.getenv('PATH_APP')
     filename = os.path.join(path_app, 'pdf.exe')
     
+    imports_report()
     print(f"Fin de la ejecución sft_rend.exe ...")
     print(f"-----------------------------------")
 
     try: 
-        script = Script(filename)
+        script = Script(filename, ["--profile"] if profiler.enabled else [])
         script.run()
     except Exception as e:
         print(f"Error al ejecutar el script {filename}: {e}")
@@ -0,0 +1,268 @@
+"""SQLite stand-in for the Softland/TYE stored procedures.
+
+Emulates the procedures called by main.py, pdf.py, sft_rend.py and sft_precar.py over local
+SQLite tables, with the same parameters and result shapes, so the whole chain can run on a
+development machine. It is selected with DB_BACKEND=sqlite and SQLITE_PATH in the .env file.
+"""
+import re
+import sqlite3
+import datetime
+
+
+class Error(Exception):
+    """Mirrors pyodbc.Error: args are (sqlstate, message)"""
+
+class IntegrityError(Error):
+    pass
+
+class OperationalError(Error):
+    pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS CORRTH (
+    INICIA TEXT, PERIOD INTEGER, NROMOV INTEGER, NROSFT INTEGER, NROTYE INTEGER, TIPREN INTEGER,
+    MONEDA TEXT, IMPORT REAL, IMPANT REAL, USRAUT TEXT, TARJET TEXT, CTACTE TEXT, COMPAG TEXT,
+    NOVEDA INTEGER, NROREN INTEGER,
+    PRIMARY KEY (TIPREN, NROTYE)
+);
+CREATE TABLE IF NOT EXISTS CORRTI (
+    TIPREN INTEGER, NROTYE INTEGER, CTACTE TEXT, PERIOD INTEGER, NROMOV INTEGER, NROITM INTEGER,
+    TIPCOM TEXT, NROORI TEXT, FCHMOV TEXT, IMPORT REAL, MONEDA TEXT, CUENTA TEXT, CODIRL TEXT,
+    CODIRP TEXT, CODVIN TEXT, JURISD TEXT, NOMBRE TEXT, NRODOC TEXT, OLEOLE TEXT, OLETYE TEXT,
+    ARTCOD TEXT, CONCEP TEXT, OBSERV TEXT, NORECO TEXT, PERSON TEXT, REEMBO TEXT,
+    PRIMARY KEY (TIPREN, NROTYE, NROITM)
+);
+CREATE TABLE IF NOT EXISTS CORRTP (
+    TIPREN INTEGER, NROTYE INTEGER, CTACTE TEXT, PERIOD INTEGER, NROMOV INTEGER, NROITM INTEGER,
+    NROITP INTEGER, CODIRL TEXT, CODIRP TEXT, CODVIN TEXT, IMPORT REAL,
+    PRIMARY KEY (TIPREN, NROTYE, NROITM, NROITP)
+);
+CREATE TABLE IF NOT EXISTS PRECAR (
+    TIPREN INTEGER, NROTYE INTEGER, NROITM INTEGER, FECHA TEXT,
+    PRIMARY KEY (TIPREN, NROTYE, NROITM)
+);
+CREATE TABLE IF NOT EXISTS MAIL (
+    FECHA TEXT, CODPER TEXT, DIREML TEXT, DIRECC TEXT, DIRCCO TEXT, VARIABLES TEXT, ADJUNTOS TEXT
+);
+"""
+
+EXEC = re.compile(r"^\s*EXEC\s+(?:[\w\[\]]+\.)*\[?(\w+)\]?\s*(.*)$", re.IGNORECASE | re.DOTALL)
+PARAM = re.compile(r"@(\w+)\s*=\s*('(?:[^']|'')*'|\?|[^,\s]+)", re.DOTALL)
+
+
+def parse_value(value, params):
+    if value == "?":
+        return params.pop(0)
+    if value.startswith("'"):
+        return value[1:-1].replace("''", "'")
+    if value.upper() == "NULL":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def parse_exec(query, params=()):
+    match = EXEC.match(query)
+    if not match:
+        return None, {}
+    params = list(params)
+    name, args = match.groups()
+    return name.upper(), {key.upper(): parse_value(value, params) for key, value in PARAM.findall(args)}
+
+
+def filters(args, columns, alias=""):
+    # Filtros opcionales de los procedimientos por partición (PERIOD, TIPREN, ...)
+    conditions = [f"{alias}{key} = ?" for key in columns if args.get(key) is not None]
+    return "".join(f" AND {condition}" for condition in conditions), [args[key] for key in columns if args.get(key) is not None]
+
+
+class Procedures:
+    """Each method emulates the stored procedure of the same name and returns (columns, rows) or None"""
+    def __init__(self, db):
+        self.db = db
+
+    def SP_CO_REND_MAX_CORRTH(self, INICIA, PERIOD):
+        row = self.db.execute("SELECT COALESCE(MAX(NROMOV), 0) + 1 FROM CORRTH WHERE INICIA = ? AND PERIOD = ?", (INICIA, PERIOD)).fetchone()
+        return ["NROMOV"], [row]
+
+    def SP_CO_REND_INS_CORRTH(self, INICIA, PERIOD, NROMOV, NROSFT, NROTYE, TIPREN, MONEDA, IMPORT, IMPANT, USRAUT, TARJET):
+        self.db.execute("""INSERT INTO CORRTH (INICIA, PERIOD, NROMOV, NROSFT, NROTYE, TIPREN, MONEDA, IMPORT, IMPANT, USRAUT, TARJET, NOVEDA)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)""",
+                        (INICIA, PERIOD, NROMOV, NROSFT, NROTYE, TIPREN, MONEDA, IMPORT, IMPANT, USRAUT, TARJET))
+
+    def SP_CO_REND_INS_CORRTI(self, **args):
+        columns = ("TIPREN", "NROTYE", "CTACTE", "PERIOD", "NROMOV", "NROITM", "TIPCOM", "NROORI", "FCHMOV", "IMPORT", "MONEDA", "CUENTA",
+                   "CODIRL", "CODIRP", "CODVIN", "JURISD", "NOMBRE", "NRODOC", "OLEOLE", "OLETYE", "ARTCOD", "CONCEP", "OBSERV", "NORECO",
+                   "PERSON", "REEMBO")
+        self.db.execute(f"INSERT INTO CORRTI ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})", [args.get(column) for column in columns])
+
+    def SP_CO_REND_INS_CORRTP(self, **args):
+        columns = ("TIPREN", "NROTYE", "CTACTE", "PERIOD", "NROMOV", "NROITM", "NROITP", "CODIRL", "CODIRP", "CODVIN", "IMPORT")
+        self.db.execute(f"INSERT INTO CORRTP ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})", [args.get(column) for column in columns])
+
+    def SP_CO_REND_UPDATE_ANTICI(self, NROANT, NROTYE):
+        self.db.execute("UPDATE CORRTH SET NROREN = ? WHERE TIPREN = 4 AND NROTYE = ?", (NROTYE, NROANT))
+
+    def SP_CO_REND_GET_UPDATE_CORRTH(self):
+        rows = self.db.execute("""SELECT NROTYE, TIPREN, NROSFT, IMPORT, COMPAG, NOVEDA, CTACTE, IMPANT FROM CORRTH
+                                  WHERE COALESCE(NOVEDA, 0) < 2 ORDER BY TIPREN, NROTYE""").fetchall()
+        return ["NROTYE", "TIPREN", "NROSFT", "IMPORT", "COMPAG", "NOVEDA", "CTACTE", "IMPANT"], rows
+
+    def SP_CO_REND_UPDATE_CORRTH(self, TIPREN, NROTYE, NOVEDA):
+        self.db.execute("UPDATE CORRTH SET NOVEDA = ? WHERE TIPREN = ? AND NROTYE = ?", (NOVEDA, TIPREN, NROTYE))
+
+    def SP_CO_REND_GET_OLEOLE(self):
+        rows = self.db.execute("""SELECT H.INICIA, I.CTACTE, I.PERIOD, I.NROMOV, I.NROITM, I.OLETYE, I.TIPREN, I.NROTYE
+                                  FROM CORRTI I JOIN CORRTH H ON H.TIPREN = I.TIPREN AND H.NROTYE = I.NROTYE
+                                  WHERE COALESCE(I.OLETYE, '') <> '' AND COALESCE(I.OLEOLE, '') = ''""").fetchall()
+        return ["INICIA", "CTACTE", "PERIOD", "NROMOV", "NROITM", "OLETYE", "TIPREN", "NROTYE"], rows
+
+    def SP_CO_REND_UPDATE_OLEOLE(self, FLPATH, TIPREN, NROTYE, NROITM):
+        self.db.execute("UPDATE CORRTI SET OLEOLE = ? WHERE TIPREN = ? AND NROTYE = ? AND NROITM = ?", (FLPATH, TIPREN, NROTYE, NROITM))
+
+    def SP_GR_PRO_MAIL(self, CODPER, DIREML, DIRECC, DIRCCO, VARIABLES, ADJUNTOS):
+        self.db.execute("INSERT INTO MAIL VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (datetime.datetime.now().isoformat(), CODPER, DIREML, DIRECC, DIRCCO, VARIABLES, ADJUNTOS))
+
+    def SP_CO_REND_GET_PARTICIONES_TYE(self):
+        rows = self.db.execute("SELECT DISTINCT PERIOD, TIPREN FROM CORRTH WHERE NROSFT IS NULL ORDER BY PERIOD, TIPREN").fetchall()
+        return ["PERIOD", "TIPREN"], rows
+
+    def SP_CO_PRO_RENDICIONES_TYE(self, **args):
+        # Asigna el número de Softland a las rendiciones y anticipos pendientes
+        where, values = filters(args, ("PERIOD", "TIPREN"))
+        pending = self.db.execute(f"SELECT TIPREN, NROTYE FROM CORRTH WHERE NROSFT IS NULL{where} ORDER BY TIPREN, NROTYE", values).fetchall()
+        for tipren, nrotye in pending:
+            self.db.execute("""UPDATE CORRTH SET NROSFT = (SELECT COALESCE(MAX(NROSFT), 0) + 1 FROM CORRTH), CTACTE = INICIA
+                               WHERE TIPREN = ? AND NROTYE = ?""", (tipren, nrotye))
+
+    def SP_CO_GEN_PARTICIONES_PRECARGAS_TYE(self):
+        rows = self.db.execute("""SELECT DISTINCT H.PERIOD, H.TIPREN FROM CORRTH H JOIN CORRTI I ON H.TIPREN = I.TIPREN AND H.NROTYE = I.NROTYE
+                                  LEFT JOIN PRECAR P ON P.TIPREN = I.TIPREN AND P.NROTYE = I.NROTYE AND P.NROITM = I.NROITM
+                                  WHERE H.NROSFT IS NOT NULL AND P.NROTYE IS NULL ORDER BY H.PERIOD, H.TIPREN""").fetchall()
+        return ["PERIOD", "TIPREN"], rows
+
+    def SP_CO_GEN_PRECARGAS_TYE(self, **args):
+        where, values = filters(args, ("PERIOD", "TIPREN"), "H.")
+        self.db.execute(f"""INSERT INTO PRECAR (TIPREN, NROTYE, NROITM, FECHA)
+                            SELECT I.TIPREN, I.NROTYE, I.NROITM, ? FROM CORRTH H JOIN CORRTI I ON H.TIPREN = I.TIPREN AND H.NROTYE = I.NROTYE
+                            LEFT JOIN PRECAR P ON P.TIPREN = I.TIPREN AND P.NROTYE = I.NROTYE AND P.NROITM = I.NROITM
+                            WHERE H.NROSFT IS NOT NULL AND P.NROTYE IS NULL{where}""",
+                        [datetime.datetime.now().isoformat()] + values)
+
+
+class Cursor:
+    """Subset of the pyodbc.Cursor interface used by the scripts"""
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rows = []
+        self.rowcount = -1
+        self.fast_executemany = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # pyodbc confirma la transacción al salir del bloque with si no hubo errores
+        if exc_type is None:
+            self.connection.commit()
+        self.close()
+
+    def execute(self, query, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        result = self.connection.call(query, params)
+        self.rowcount = -1
+        if result is None:
+            self.description, self.rows = None, []
+        elif isinstance(result, int):
+            self.description, self.rows, self.rowcount = None, [], result
+        else:
+            columns, rows = result
+            self.description = [(column, None, None, None, None, None, True) for column in columns]
+            self.rows = [tuple(row) for row in rows]
+        return self
+
+    def executemany(self, query, seq_of_params):
+        for params in seq_of_params:
+            self.execute(query, params)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def nextset(self):
+        return False
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.rows = []
+
+
+class Connection:
+    """Subset of the pyodbc.Connection interface backed by a SQLite file"""
+    def __init__(self, path, timeout=30):
+        self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.procedures = Procedures(self.db)
+
+    def call(self, query, params=()):
+        name, args = parse_exec(query, params)
+        try:
+            if name is None:
+                if re.match(r"^\s*SET\s", query, re.IGNORECASE):
+                    return None
+                cursor = self.db.execute(query, params)
+                # Las sentencias sin resultado devuelven la cantidad de filas afectadas, como rowcount en pyodbc
+                return ([column[0] for column in cursor.description], cursor.fetchall()) if cursor.description else cursor.rowcount
+            procedure = getattr(self.procedures, name, None)
+            if procedure is None:
+                raise Error("42000", f"[42000] Could not find stored procedure '{name}'. (2812)")
+            return procedure(**args)
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError("23000", f"[23000] {e} (2627)")
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e):
+                raise OperationalError("HYT00", f"[HYT00] Lock request time out period exceeded: {e} (1222)")
+            raise OperationalError("42000", f"[42000] {e}")
+        except TypeError as e:
+            raise Error("42000", f"[42000] {name}: {e} (8144)")
+
+    def cursor(self):
+        return Cursor(self)
+
+    def execute(self, query, *params):
+        return self.cursor().execute(query, *params)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+
+def connect(path, timeout=30):
+    return Connection(path, timeout)